@@ -0,0 +1,15 @@
+import pytest
+
+from zs.rss.migrations import migrate_database
+from zs.rss.models import DATABASE
+
+
+@pytest.fixture()
+def database(tmp_path):
+    origin = DATABASE.database
+    DATABASE.init(str(tmp_path / "rss.db"))
+    DATABASE.connect()
+    migrate_database()
+    yield DATABASE
+    DATABASE.close()
+    DATABASE.init(origin)
@@ -0,0 +1,67 @@
+import random
+import time
+from collections import defaultdict
+
+import pytest
+
+from zs.rss.dispatcher import Dispatcher
+
+
+class FakeResponse:
+    def __init__(self, status_code=200, headers=None):
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+def send(item):
+    time.sleep(random.random() * 0.002)
+    return FakeResponse()
+
+
+@pytest.mark.parametrize("ordered", [True, False])
+def test_dispatch_reads_items_incrementally(ordered):
+    consumed = []
+
+    def items():
+        for idx in range(200):
+            consumed.append(idx)
+            yield (idx % 3, idx)
+
+    dispatcher = Dispatcher(workers=4, rate=0, ordered=ordered, max_pending=8)
+    results = dispatcher.dispatch(items(), send, key=lambda item: item[0])
+
+    first = next(results)
+    assert first.ok
+    assert len(consumed) <= 9
+
+    rest = list(results)
+    assert sorted(result.item[1] for result in [first] + rest) == list(range(200))
+
+
+def test_dispatch_keeps_order_per_destination():
+    items = [(idx % 5, idx) for idx in range(300)]
+    dispatcher = Dispatcher(workers=3, rate=0, ordered=True, max_pending=16)
+
+    sent = defaultdict(list)
+    for result in dispatcher.dispatch(items, send, key=lambda item: item[0]):
+        dest, idx = result.item
+        sent[dest].append(idx)
+
+    assert sum(len(indexes) for indexes in sent.values()) == len(items)
+    for indexes in sent.values():
+        assert indexes == sorted(indexes)
+
+
+def test_dispatch_retries_rate_limited_items():
+    responses = {}
+
+    def flaky_send(item):
+        if item not in responses:
+            responses[item] = True
+            return FakeResponse(429, {"Retry-After": "0"})
+        return FakeResponse(201)
+
+    dispatcher = Dispatcher(workers=2, rate=0, max_pending=2)
+    results = list(dispatcher.dispatch(range(6), flaky_send, key=lambda item: item % 2))
+    assert sorted(result.item for result in results) == list(range(6))
+    assert all(result.ok and result.attempts == 2 for result in results)
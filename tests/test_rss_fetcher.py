@@ -0,0 +1,84 @@
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from zs.rss.fetcher import FeedFetcher
+
+RSS_TEMPLATE = """<?xml version="1.0"?>
+<rss version="2.0"><channel><title>test</title>
+{items}
+</channel></rss>
+"""
+GOOD_FEED = RSS_TEMPLATE.format(
+    items="<item><title>hello</title><link>https://example.com/1</link></item>"
+)
+# 缺少 link 的条目会让 parse_entry 抛出 KeyError
+BROKEN_FEED = RSS_TEMPLATE.format(items="<item><title>no link</title></item>")
+
+
+class FeedHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        body = {"/good": GOOD_FEED, "/broken": BROKEN_FEED}.get(self.path, GOOD_FEED).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/rss+xml")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.path != "/slow":
+            self.wfile.write(body)
+            return
+
+        # 每次只返回一个字节，单次读取不会超时，但整体下载远超 timeout
+        try:
+            for byte in body:
+                self.wfile.write(bytes([byte]))
+                self.wfile.flush()
+                time.sleep(0.2)
+        except OSError:
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeFeed:
+    etag = None
+    last_modified = None
+
+    def __init__(self, name, url):
+        self.name = name
+        self.feed_link = url
+
+    def get_validators(self):
+        return {}
+
+
+@pytest.fixture()
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FeedHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_port}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_fetch_all_isolates_failed_feeds(server):
+    feeds = [FakeFeed(name, f"{server}/{name}") for name in ("good", "broken", "slow")]
+    fetcher = FeedFetcher(workers=3, timeout=1)
+
+    start = time.time()
+    results = {result.feed.name: result for result in fetcher.fetch_all(feeds)}
+    assert time.time() - start < 5
+
+    assert results["good"].ok
+    assert [entry["link"] for entry in results["good"].entries] == ["https://example.com/1"]
+
+    assert not results["broken"].ok
+    assert "KeyError" in results["broken"].error
+
+    assert not results["slow"].ok
+    assert "deadline" in results["slow"].error
+    assert results["slow"].latency < 2
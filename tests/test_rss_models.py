@@ -0,0 +1,240 @@
+import datetime
+import logging
+
+import pytest
+
+from zs.rss import migrations
+from zs.rss.migrations import get_schema_version, migrate_database
+from zs.rss.models import (
+    HUGINN_DEST,
+    Article,
+    Feed,
+    Outbox,
+    SearchIndex,
+    SentHistory,
+    WechatArticle,
+    WechatArticleSentHistory,
+)
+
+START = datetime.datetime(2024, 1, 1)
+
+
+def wx_article(idx, name="晚点LatePost", **kwargs):
+    return dict(
+        name=name,
+        title=f"title {idx}",
+        description=f"description {idx}",
+        url=f"https://mp.weixin.qq.com/s?sn={idx}",
+        date=START + datetime.timedelta(hours=idx),
+        **kwargs,
+    )
+
+
+def test_wechat_article_bulk_ingest(database):
+    WechatArticle.insert(**wx_article(0)).execute()
+
+    items = [wx_article(idx, sent=idx % 2 == 0) for idx in range(5)] + [wx_article(1)]
+    batches = list(WechatArticle.bulk_ingest(items, batch_size=4))
+
+    assert [processed for processed, _, _ in batches] == [4, 2]
+    new_urls = [row["url"] for _, new_rows, _ in batches for row in new_rows]
+    assert new_urls == [wx_article(idx)["url"] for idx in range(1, 5)]
+    assert sum(sent for _, _, sent in batches) == 3
+    assert WechatArticle.select().count() == 5
+    assert WechatArticleSentHistory.select().count() == 3
+
+    # 重复导入时不会有新文章
+    batches = list(WechatArticle.bulk_ingest(items, batch_size=4))
+    assert [new_rows for _, new_rows, _ in batches] == [[], []]
+
+
+def create_feed(name, size):
+    feed = Feed.create(
+        name=name,
+        title=name,
+        subtitle="",
+        link=f"https://{name}.example.com",
+        feed_link=f"https://{name}.example.com/rss",
+        version="rss20",
+    )
+    entries = [
+        {
+            "title": f"{name} {idx}",
+            "summary": "summary",
+            "link": f"https://{name}.example.com/{idx}",
+            "publish_date": START + datetime.timedelta(minutes=idx),
+        }
+        for idx in range(size)
+    ]
+    Article.bulk_ingest(feed, entries)
+    return feed
+
+
+def count_queries(caplog, func):
+    """返回执行 func 时发出的 SQL 语句数量，peewee 会在 DEBUG 级别记录每条语句"""
+    caplog.clear()
+    with caplog.at_level(logging.DEBUG, logger="peewee"):
+        func()
+
+    return len([record for record in caplog.records if record.name == "peewee"])
+
+
+@pytest.mark.parametrize(
+    "list_articles",
+    [
+        lambda name: Article.search_by_feed(name),
+        lambda name: Article.search_by_feed(name, limit=1000),
+        lambda name: Article.search_by_feed(name, status="unsent", dest="slack"),
+        lambda name: Article.search_by_feed(None),
+        lambda name: Article.iter_by_feed(name, batch_size=1000),
+        lambda name: Article.iter_by_feed(None, status="unsent", dest="slack", batch_size=1000),
+    ],
+)
+def test_list_articles_without_per_row_queries(database, caplog, list_articles):
+    create_feed("small", 5)
+    create_feed("large", 100)
+    SentHistory.mark_sent("https://large.example.com/0", "slack")
+
+    counts = {}
+    for name in ("small", "large"):
+        names = []
+        counts[name] = count_queries(
+            caplog, lambda: names.extend(article.feed.name for article in list_articles(name))
+        )
+        assert names and set(names) <= {"small", "large"}
+
+    assert counts["small"] == counts["large"] <= 3
+
+
+def test_iter_by_feed_rows(database):
+    create_feed("news", 7)
+    rows = list(Article.iter_by_feed("news", batch_size=3, row_type="dicts"))
+    assert [row["title"] for row in rows] == [f"news {idx}" for idx in range(7)]
+    assert {row["feed_name"] for row in rows} == {"news"}
+
+    rows = list(Article.iter_by_feed("news", batch_size=3, row_type="tuples"))
+    assert [row[2] for row in rows] == [f"news {idx}" for idx in range(7)]
+    assert {row[-1] for row in rows} == {"news"}
+
+    articles = list(Article.iter_by_feed("news", batch_size=3))
+    assert [article.title for article in articles] == [f"news {idx}" for idx in range(7)]
+
+
+def test_search_index(database):
+    create_feed("news", 3)
+    list(WechatArticle.bulk_ingest([wx_article(idx) for idx in range(3)]))
+
+    results = SearchIndex.search("title 1")
+    assert [row.url for row in results] == [wx_article(1)["url"]]
+
+    results = SearchIndex.search("news", kind=SearchIndex.RSS, start=START)
+    assert {row.source for row in results} == {"news"}
+    assert len(results) == 3
+
+    results = SearchIndex.search("summary", end=START + datetime.timedelta(minutes=2))
+    assert {row.title for row in results} == {"news 0", "news 1"}
+
+    # 文章删除后同步从索引中移除
+    Article.delete().where(Article.title == "news 0").execute()
+    assert [row.title for row in SearchIndex.search("news 0")] == []
+
+
+def test_migrate_database_commits_each_step(database, monkeypatch):
+    def noop():
+        pass
+
+    def broken():
+        raise RuntimeError("broken migration")
+
+    version = get_schema_version()
+    monkeypatch.setattr(migrations, "MIGRATIONS", migrations.MIGRATIONS + [noop, broken])
+    with pytest.raises(RuntimeError):
+        migrate_database()
+
+    assert get_schema_version() == version + 1
+
+
+def test_outbox_backoff_and_dead_letter(database):
+    delays = []
+    for attempts in range(1, Outbox.MAX_ATTEMPTS):
+        before = datetime.datetime.now()
+        item = Outbox.record_failure("https://example.com/1", "slack", f"error {attempts}")
+        after = datetime.datetime.now()
+
+        # 第 n 次失败后等待 BASE_DELAY * 2^(n-1) 秒（不超过 MAX_DELAY），随机取其一半到全部
+        delay = min(Outbox.MAX_DELAY, Outbox.BASE_DELAY * 2 ** (attempts - 1))
+        assert item.status == Outbox.PENDING
+        assert item.attempts == attempts
+        assert before + datetime.timedelta(seconds=delay / 2) <= item.next_attempt
+        assert item.next_attempt <= after + datetime.timedelta(seconds=delay)
+        delays.append(delay)
+
+    assert delays == sorted(delays) and delays[-1] > delays[0]
+
+    item = Outbox.record_failure("https://example.com/1", "slack", "last error")
+    assert (item.status, item.attempts, item.last_error) == (
+        Outbox.DEAD,
+        Outbox.MAX_ATTEMPTS,
+        "last error",
+    )
+    assert Outbox.select().count() == 1
+
+
+def defer(url, dest, status):
+    """将 url 放入发送队列，status 为 due 时已到重试时间"""
+    item = Outbox.record_failure(url, dest, "error")
+    if status == "due":
+        item.next_attempt = datetime.datetime.now() - datetime.timedelta(seconds=1)
+    elif status == Outbox.DEAD:
+        item.status = Outbox.DEAD
+    item.save()
+
+
+def test_skip_deferred_articles(database):
+    create_feed("news", 4)
+    defer("https://news.example.com/1", "slack", Outbox.PENDING)
+    defer("https://news.example.com/2", "slack", Outbox.DEAD)
+    defer("https://news.example.com/3", "slack", "due")
+    # 其他目标的发送队列不影响结果
+    defer("https://news.example.com/0", "telegram", Outbox.DEAD)
+
+    titles = [a.title for a in Article.search_by_feed("news", dest="slack", skip_deferred=True)]
+    assert titles == ["news 0", "news 3"]
+    titles = [a.title for a in Article.search_by_feed("news", dest="slack")]
+    assert titles == [f"news {idx}" for idx in range(4)]
+
+    list(WechatArticle.bulk_ingest([wx_article(idx) for idx in range(4)]))
+    defer(wx_article(1)["url"], HUGINN_DEST, Outbox.PENDING)
+    defer(wx_article(2)["url"], HUGINN_DEST, Outbox.DEAD)
+    defer(wx_article(3)["url"], HUGINN_DEST, "due")
+
+    titles = [a.title for a in WechatArticle.search_by_name(skip_deferred=True)]
+    assert titles == ["title 0", "title 3"]
+    titles = [a.title for a in WechatArticle.search_by_name(limit=10, skip_deferred=True)]
+    assert titles == ["title 0", "title 3"]
+
+
+def test_outbox_replay_and_success(database):
+    create_feed("news", 3)
+    for idx in range(3):
+        defer(f"https://news.example.com/{idx}", "slack", Outbox.DEAD)
+    defer("https://news.example.com/0", "telegram", Outbox.DEAD)
+
+    dead = Outbox.select().where(Outbox.dest == "slack").order_by(Outbox.id)
+    assert Outbox.replay(dest="slack", ids=[dead[0].id, dead[1].id]) == 2
+    assert Outbox.replay(dest="slack") == 1
+
+    # 重新入队后立即可以发送
+    items = Outbox.select().where(Outbox.dest == "slack")
+    assert {(item.status, item.attempts) for item in items} == {(Outbox.PENDING, 0)}
+    titles = [a.title for a in Article.search_by_feed("news", dest="slack", skip_deferred=True)]
+    assert titles == ["news 0", "news 1", "news 2"]
+
+    # 其他目标的死信不受影响
+    item = Outbox.get(Outbox.dest == "telegram")
+    assert item.status == Outbox.DEAD
+
+    assert Outbox.record_success("https://news.example.com/0", "slack") == 1
+    assert Outbox.record_success("https://news.example.com/0", "slack") == 0
+    assert Outbox.select().where(Outbox.dest == "slack").count() == 2
+    assert Outbox.select().where(Outbox.dest == "telegram").count() == 1
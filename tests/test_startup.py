@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 命令行启动时不应加载的重型依赖，它们只在用到的子命令中导入
+HEAVY_MODULES = {
+    "telethon",
+    "feedparser",
+    "tabulate",
+    "dateutil",
+    "requests",
+    "peewee",
+    "playhouse",
+    "lxml",
+    "pydantic",
+}
+
+
+def test_cli_startup_skips_heavy_modules():
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-X",
+            "importtime",
+            "-c",
+            "import zs.cli.main, zs.cli.rss, zs.cli.telegram",
+        ],
+        cwd=ROOT_DIR,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        check=True,
+    )
+
+    # 每行形如 `import time:  self [us] | cumulative | module`，module 前的缩进表示嵌套层级
+    imported = set()
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            module = line.rsplit("|", 1)[1].strip()
+            imported.add(module.split(".")[0])
+
+    assert "zs" in imported
+    assert not imported & HEAVY_MODULES
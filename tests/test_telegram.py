@@ -0,0 +1,150 @@
+import asyncio
+import re
+
+import pytest
+from telethon.tl.types import PeerUser
+
+from zs.telegram import AsyncTelegramClient, IgnoreRules, Message, MessageType, UserCache
+from zs.telegram_replay import ReplayMessage
+
+
+def wx_text_message(raw_text):
+    return ReplayMessage(
+        {
+            "id": 1,
+            "date": "2024-01-01T00:00:00+00:00",
+            "chat": {"title": "微信 group"},
+            "raw_text": raw_text,
+        }
+    )
+
+
+@pytest.mark.parametrize(
+    "raw_text, user, content",
+    [
+        ("Alice: hi there", "Alice", "hi there"),
+        (" Bob :  hi  ", "Bob", "hi"),
+        ("a: b: c", "a: b", "c"),
+        ("x:y", "unknown", "x:y"),
+        ("just text", "unknown", "just text"),
+        ("Alice:", "unknown", "Alice:"),
+        ("💬👤 Gao[Group]: hello", "Gao", "hello"),
+        ("You:\nYou:", "You", ""),
+        ("Error: Empty Sticker received", "unknown", "Error: Empty Sticker received"),
+        # 发送者单独占一行
+        ("Carol:\nfirst\nsecond", "Carol", "first\nsecond"),
+        ("Dan:\nx: y\nz", "Dan", "x: y\nz"),
+        ("Dan:\n\nz", "Dan", "z"),
+        # 每行都是同一个发送者时合并为多行消息
+        ("Bob: line one\nBob: line two", "Bob", "line one\n line two"),
+        ("Bob: a:\nBob: b", "Bob", "a\n b"),
+        # 多个发送者时只取第一个，其余内容原样保留
+        ("Eve: a\nFrank: b", "Eve", "a\nFrank: b"),
+        ("A: 1\n\nA: 2", "A", "1\n\nA: 2"),
+        ("no sender\nA: 1", "no sender", "A: 1"),
+        ("🔗 https://example.com\nmore", "https://example.com", "more"),
+    ],
+)
+def test_parse_wx_text_message(raw_text, user, content):
+    msg = Message.parse_wx_text_message(wx_text_message(raw_text))
+    assert msg.type == MessageType.WX_TEXT
+    assert (msg.user, msg.content) == (user, content)
+
+
+class FakeUser:
+    def __init__(self, username):
+        self.username = username
+
+
+class FakeTelethonClient:
+    """只实现 get_entity 的 Telethon 客户端，记录查询次数"""
+
+    def __init__(self, users):
+        self.users = users
+        self.calls = 0
+
+    async def get_entity(self, peer):
+        self.calls += 1
+        return FakeUser(self.users[peer.user_id])
+
+
+def user_message(message_id, user_id):
+    message = ReplayMessage(
+        {
+            "id": message_id,
+            "date": "2024-01-01T00:00:00+00:00",
+            "chat": {"title": "group"},
+            "raw_text": "hello",
+        }
+    )
+    message.from_id = PeerUser(user_id)
+    # 发送者已由异步客户端查询时不应再调用同步的 get_entity
+    message.client = None
+    return message
+
+
+def test_async_parse_message_resolves_sender_once():
+    client = AsyncTelegramClient.__new__(AsyncTelegramClient)
+    client.client = FakeTelethonClient({1: "alice", 2: None})
+    client.config_manager = None
+    client.user_cache = UserCache()
+
+    async def parse_all():
+        return [
+            await client.parse_message(user_message(idx, user_id))
+            for idx, user_id in enumerate([1, 2, 1, 2])
+        ]
+
+    messages = asyncio.run(parse_all())
+    assert [msg.user for msg in messages] == ["alice", None, "alice", None]
+    assert client.client.calls == 2
+
+
+def test_parse_without_sender_uses_chat_name():
+    message = wx_text_message("hello")
+    message.chat.title = "group"
+    assert Message.parse(message, MessageType.TEXT).user == "group"
+
+
+@pytest.mark.parametrize(
+    "patterns, text, ignored",
+    [
+        # ^ 开头的纯文本规则按前缀比较
+        (["^/", "^Cancelled"], "/start", True),
+        (["^/", "^Cancelled"], "not /start", False),
+        (["^Cancelled"], "Cancelled by user", True),
+        # 纯文本规则按子串查找
+        (["System", "WeChat Slave"], "from WeChat Slave", True),
+        (["System"], "system", False),
+        # 多条正则合并为一个
+        ([r"foo\d+", r"ba[rz]$"], "xx foo42", True),
+        ([r"foo\d+", r"ba[rz]$"], "bazaar", False),
+        ([r"foo\d+", r"ba[rz]$"], "bar baz", True),
+        # 包含分组的规则单独编译，反向引用不受合并影响
+        ([r"(x)\1", r"(ab)\1"], "abab", True),
+        ([r"(x)\1", r"(ab)\1"], "abba", False),
+        ([r"(?P<c>\w)(?P=c)", r"(?P<c>\d)z"], "1z", True),
+        # 全局标记无法合并，分别编译
+        ([r"(?i)hello", r"world\d"], "HELLO", True),
+        ([r"(?i)hello", r"world\d"], "WORLD1", False),
+        ([r"(?i)hello", r"world\d"], "world1", True),
+    ],
+)
+def test_ignore_rules(patterns, text, ignored):
+    rules = IgnoreRules(patterns)
+    assert bool(rules.search(text)) is ignored
+    # 与逐条规则单独查找的结果一致
+    assert any(re.findall(pattern, text) for pattern in patterns) is ignored
+
+
+def test_ignore_rules_compile_paths():
+    rules = IgnoreRules(["^/", "System", r"foo\d+", r"ba[rz]$", r"(ab)\1"])
+    assert rules.prefixes == ("/",)
+    assert rules.keywords == ("System",)
+    assert [pattern.pattern for pattern in rules.patterns] == [
+        r"(ab)\1",
+        r"(?:foo\d+)|(?:ba[rz]$)",
+    ]
+
+    rules = IgnoreRules([r"(?i)hello", r"world\d"])
+    assert [pattern.pattern for pattern in rules.patterns] == [r"(?i)hello", r"world\d"]
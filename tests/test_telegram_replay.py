@@ -0,0 +1,125 @@
+import os
+
+import pytest
+from click.testing import CliRunner
+
+from zs.cli.telegram import main
+from zs.telegram import (
+    DEFAULT_IGNORED_MSG_PATTERNS,
+    MessageType,
+    TelegramConfigManager,
+    compile_ignored_patterns,
+)
+from zs.telegram_replay import (
+    ReplayMessage,
+    benchmark_parse,
+    generate_fixtures,
+    load_fixtures,
+    replay_messages,
+)
+
+FIXTURE_FILE = os.path.join(os.path.dirname(__file__), "fixtures", "telegram_messages.jsonl")
+DOWNLOAD_PATH = TelegramConfigManager.DEFAULT_DOWNLOAD_PATH
+
+
+def replay(ignore_rules=None):
+    return list(replay_messages(load_fixtures(FIXTURE_FILE), ignore_rules=ignore_rules))
+
+
+def test_replay_fixtures():
+    rules = compile_ignored_patterns(DEFAULT_IGNORED_MSG_PATTERNS)
+    messages = {msg.id: msg for msg in replay(rules)}
+
+    # 6、7 命中忽略规则，5 是没有文字的 sticker，解析后没有内容
+    assert sorted(messages) == [1, 2, 3, 4, 8, 9, 10, 11, 12, 13]
+
+    expected = {
+        1: (MessageType.TEXT, "alice", "hello world"),
+        2: (MessageType.IMAGE, "alice", os.path.join(DOWNLOAD_PATH, "group_2.jpg")),
+        4: (MessageType.OTHER, "bob", "report.pdf"),
+        8: (MessageType.TEXT, "news", "channel post"),
+        9: (MessageType.WX_TEXT, "Alice", "hi there"),
+        10: (MessageType.WX_TEXT, "Bob", "line one\n line two"),
+        11: (MessageType.WX_TEXT, "Carol", "first\nsecond"),
+        12: (MessageType.WX_IMAGE, "张三", os.path.join(DOWNLOAD_PATH, "微信 group_12.jpg")),
+    }
+    for msg_id, (msg_type, user, content) in expected.items():
+        msg = messages[msg_id]
+        assert (msg.type, msg.user, msg.content) == (msg_type, user, content)
+
+    multi = messages[3]
+    assert multi.type == MessageType.MULTI
+    assert multi.content == [
+        {"type": MessageType.IMAGE, "content": os.path.join(DOWNLOAD_PATH, "group_3.jpg")},
+        {"type": MessageType.TEXT, "content": "看图"},
+    ]
+
+    article = messages[13]
+    assert article.type == MessageType.WX_ARTICLE
+    assert article.user == "晚点LatePost"
+    assert article.content == {
+        "title": "晚点独家",
+        "desc": "好未来披露员工销售造假始末",
+        "url": "http://mp.weixin.qq.com/s?__biz=MzA&mid=2650&idx=1&sn=abc",
+        "date": "2024-01-01 00:00:13+00:00",
+    }
+
+
+def test_replay_without_ignore_rules():
+    assert [msg.id for msg in replay()] == [1, 2, 3, 4, 6, 7, 8, 9, 10, 11, 12, 13]
+
+
+def test_generated_fixtures_cover_all_types():
+    messages = [ReplayMessage(record) for record in generate_fixtures(600)]
+    results = benchmark_parse(messages, repeat=1)
+    assert {msg_type for msg_type, _, _ in results} == {
+        MessageType.TEXT,
+        MessageType.IMAGE,
+        MessageType.MULTI,
+        MessageType.WX_TEXT,
+        MessageType.WX_IMAGE,
+        MessageType.WX_ARTICLE,
+    }
+    assert sum(count for _, count, _ in results) == 600
+
+
+@pytest.mark.parametrize(
+    "msg_type",
+    [
+        MessageType.TEXT,
+        MessageType.IMAGE,
+        MessageType.MULTI,
+        MessageType.WX_TEXT,
+        MessageType.WX_IMAGE,
+        MessageType.WX_ARTICLE,
+    ],
+)
+def test_parse_benchmark(request, msg_type):
+    pytest.importorskip("pytest_benchmark")
+    benchmark = request.getfixturevalue("benchmark")
+
+    messages = [ReplayMessage(record) for record in generate_fixtures(3000)]
+    messages = [msg for msg in messages if msg.parse().type == msg_type]
+
+    def parse_all():
+        for message in messages:
+            message.parse()
+
+    benchmark(parse_all)
+
+
+def test_replay_msgs_golden(tmp_path):
+    golden = tmp_path / "golden.jsonl"
+    runner = CliRunner()
+    result = runner.invoke(main, ["replay-msgs", "-i", FIXTURE_FILE, "-o", str(golden)])
+    assert result.exit_code == 0
+    lines = golden.read_text().splitlines()
+
+    result = runner.invoke(main, ["replay-msgs", "-i", FIXTURE_FILE, "-g", str(golden)])
+    assert f"{len(lines)} messages replayed, 0 differ" in result.output
+
+    # 解析结果少于之前保存的结果时，多出来的结果也算作不一致
+    golden.write_text("\n".join(lines + lines[-2:]) + "\n")
+    result = runner.invoke(main, ["replay-msgs", "-i", FIXTURE_FILE, "-g", str(golden)])
+    assert "2 golden messages are missing" in result.output
+    assert f"{len(lines)} messages replayed, 2 differ" in result.output
@@ -0,0 +1,92 @@
+import io
+import json
+
+import pytest
+from click.testing import CliRunner
+
+from zs.cli.rss import main
+from zs.rss.models import WechatArticle, WechatArticleSentHistory
+from zs.utils import iter_json_lines, iter_json_object
+
+DOCUMENTS = [
+    {},
+    {"a": 1},
+    {"int": 123456789, "neg": -2.5, "exp": 1.5e-10, "big": 12345678901234567890, "zero": 0},
+    {"escaped": 'quote " backslash \\ newline \n tab \t', "unicode": "中文 é 😀"},
+    {"nested": {"list": [1, -2, 3.25, [], {}], "empty": ""}, "null": None, "bool": [True, False]},
+    {'key with \\"escape\\"': [{"x": -0.0}, "}", "{", ",", ":"], "last": 10},
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 65536])
+@pytest.mark.parametrize("document", DOCUMENTS)
+@pytest.mark.parametrize("indent", [None, 2])
+def test_iter_json_object_round_trip(document, chunk_size, indent):
+    text = json.dumps(document, indent=indent, ensure_ascii=False)
+    members = list(iter_json_object(io.StringIO(text), chunk_size=chunk_size))
+    assert members == list(document.items())
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7])
+def test_iter_json_object_numbers_at_chunk_edges(chunk_size):
+    # 每个数字都在某个块的末尾被截断过，解析时需读到后续内容
+    document = {f"k{idx}": value for idx, value in enumerate([1, -23, 456.75, -7e21, 89, 1e5])}
+    for padding in range(chunk_size):
+        text = " " * padding + json.dumps(document, separators=(",", ":"))
+        members = list(iter_json_object(io.StringIO(text), chunk_size=chunk_size))
+        assert members == list(document.items())
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        '{"a": 1 "b": 2}',
+        '{"a": 1,}',
+        '{"a" 1}',
+        "{1: 2}",
+        '["a", 1]',
+        '{"a": 1',
+        '{"a": [1, 2}',
+        "",
+    ],
+)
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 65536])
+def test_iter_json_object_malformed(text, chunk_size):
+    with pytest.raises(ValueError):
+        list(iter_json_object(io.StringIO(text), chunk_size=chunk_size))
+
+
+def test_iter_json_lines():
+    text = '{"a": 1}\n\n  \n{"b": "x\\ny"}\n'
+    assert list(iter_json_lines(io.StringIO(text))) == [{"a": 1}, {"b": "x\ny"}]
+
+
+def wx_article(idx, **kwargs):
+    return dict(
+        name="晚点LatePost",
+        title=f"title {idx}",
+        desc=f"description {idx}",
+        url=f"https://mp.weixin.qq.com/s?sn={idx}",
+        date=f"2024-01-01 {idx:02d}:00:00",
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("suffix", ["json", "jsonl"])
+def test_add_wx_articles(database, tmp_path, suffix):
+    articles = [wx_article(idx, sent=idx % 2 == 0) for idx in range(5)]
+    infile = tmp_path / f"articles.{suffix}"
+    if suffix == "jsonl":
+        infile.write_text("\n".join(json.dumps(item, ensure_ascii=False) for item in articles))
+    else:
+        infile.write_text(json.dumps({item["url"]: item for item in articles}, ensure_ascii=False))
+
+    # 命令会自行打开和关闭数据库连接
+    database.close()
+    result = CliRunner().invoke(main, ["add-wx-articles", "-i", str(infile), "-b", "2"])
+    assert result.exit_code == 0, result.output
+    assert "Processed 5 articles, got 5 new articles and 3 new sent records" in result.output
+
+    titles = [article.title for article in WechatArticle.select().order_by(WechatArticle.date)]
+    assert titles == [f"title {idx}" for idx in range(5)]
+    assert WechatArticleSentHistory.select().count() == 3
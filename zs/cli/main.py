@@ -8,7 +8,6 @@ from logging.config import dictConfig
 from operator import itemgetter
 
 import click
-import requests
 
 from zs.consts import (
     IGNORE_FILE_TEMPLATE,
@@ -129,6 +128,8 @@ def init_pyrepo(repo_name, python_version):
 
 
 def fetch_bili_history(cookies, page_num=10, page_size=100, delay=1.0):
+    import requests
+
     headers = {
         "Connection": "keep-alive",
         "Host": "api.bilibili.com",
@@ -1,14 +1,8 @@
 import datetime
 import json
 from logging.config import dictConfig
-from time import mktime
 
 import click
-import feedparser
-import requests
-from dateutil import parser, tz
-from tabulate import tabulate
-from telethon import sync  # noqa
 
 from zs.rss.config import RSSConfigManager
 from zs.rss.huginn import (
@@ -16,7 +10,6 @@ from zs.rss.huginn import (
     generate_efb_scenario,
     generate_kz_scenario,
 )
-from zs.telegram import TelegramClient
 
 dictConfig(
     {
@@ -42,6 +35,16 @@ dictConfig(
 )
 
 
+def parse_date(value):
+    """解析文章时间，ISO 格式直接用标准库解析，其他格式再交给 dateutil"""
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        from dateutil import parser
+
+        return parser.parse(value)
+
+
 @click.group(context_settings={"help_option_names": ["-h", "--help"]})
 def main():
     pass
@@ -49,26 +52,27 @@ def main():
 
 @main.command("create-db")
 def create_db():
-    """创建 RSS 相关的数据库"""
-    from zs.rss.models import (
-        DATABASE,
-        Article,
-        Feed,
-        SentHistory,
-        WechatArticle,
-        WechatArticleSentHistory,
-    )
+    """创建 RSS 相关的数据库，已有的数据库会被升级到最新的结构"""
+    from zs.rss.migrations import migrate_database
+    from zs.rss.models import DATABASE
 
     DATABASE.connect()
-    DATABASE.create_tables(
-        [
-            WechatArticle,
-            WechatArticleSentHistory,
-            Feed,
-            Article,
-            SentHistory,
-        ]
-    )
+    migrate_database()
+    DATABASE.close()
+
+
+@main.command("migrate")
+def migrate_db():
+    """将已有的 RSS 数据库升级到最新的结构"""
+    from zs.rss.migrations import get_schema_version, migrate_database
+    from zs.rss.models import DATABASE
+
+    DATABASE.connect()
+    applied = migrate_database()
+    for name in applied:
+        click.secho(f"applied migration: {name}", fg="green")
+
+    click.secho(f"schema version: {get_schema_version()}")
     DATABASE.close()
 
 
@@ -76,18 +80,22 @@ def create_db():
 @click.option("-n", "--name")
 @click.option("-s", "--status", type=click.Choice(["sent", "unsent", "all"]), default="all")
 @click.option("-l", "--limit", type=int)
-def list_wx_articles(name, status, limit):
+@click.option("--offset", type=int, help="跳过最近的若干篇文章，需与 --limit 一起使用")
+def list_wx_articles(name, status, limit, offset):
     """列出当前获取到的微信公众号文章"""
-    from zs.rss.models import DATABASE, WechatArticle, WechatArticleSentHistory
+    from zs.rss.models import DATABASE, WechatArticle
 
     DATABASE.connect()
-    for article in WechatArticle.search_by_name(name, limit=limit):
-        if (
-            status == "all"
-            or (status == "sent" and WechatArticleSentHistory.is_sent(article.url))
-            or (status == "unsent" and not WechatArticleSentHistory.is_sent(article.url))
-        ):
-            print(f"[{article.date}] {article.name} -- {article.title}")
+    if limit:
+        articles = WechatArticle.search_by_name(name, limit=limit, status=status, offset=offset)
+        rows = ((article.date, article.name, article.title) for article in articles)
+    else:
+        # 不限制数量时分页读取，且不创建模型实例
+        articles = WechatArticle.iter_by_name(name, status=status, row_type="dicts")
+        rows = ((article["date"], article["name"], article["title"]) for article in articles)
+
+    for date, article_name, title in rows:
+        print(f"[{date}] {article_name} -- {title}")
 
     DATABASE.close()
 
@@ -97,9 +105,13 @@ def list_wx_articles(name, status, limit):
 @click.option("-d", "--date", default=str(datetime.date.today()))
 @click.option("-l", "--limit", type=int, default=100)
 @click.option("-v", "--verbose", is_flag=True)
-def fetch_wx_articles(name, date, limit, verbose):
+@click.option("--incremental", is_flag=True, help="只获取上次获取之后的新消息")
+def fetch_wx_articles(name, date, limit, verbose, incremental):
     """获取微信公众号文章并写入数据库中"""
+    from dateutil import tz
+
     from zs.rss.models import DATABASE, WechatArticle
+    from zs.telegram import TelegramClient
 
     client = TelegramClient()
 
@@ -107,28 +119,33 @@ def fetch_wx_articles(name, date, limit, verbose):
     start = start.replace(tzinfo=tz.tzlocal()).astimezone(datetime.timezone.utc)
 
     DATABASE.connect()
-    created_cnt, processed_cnt = 0, 0
     msgs = client.fetch_messages(
-        name, start=start, limit=limit, msg_type="wx_article", verbose=verbose
+        name,
+        start=start,
+        limit=limit,
+        msg_type="wx_article",
+        verbose=verbose,
+        incremental=incremental,
     )
-    for msg in msgs:
-        title = msg.content["title"]
-        url = msg.content["url"]
-        description = msg.content["desc"]
-        published_date = msg.timestamp
-        name = msg.user
-        _, created = WechatArticle.get_or_create(
-            name=name,
-            title=title,
-            description=description,
-            url=url,
-            date=published_date,
-        )
+    rows = (
+        {
+            "name": msg.user,
+            "title": msg.content["title"],
+            "description": msg.content["desc"],
+            "url": msg.content["url"],
+            "date": msg.timestamp,
+        }
+        for msg in msgs
+    )
+    created_cnt = 0
+    for _, new_rows, _ in WechatArticle.bulk_ingest(rows):
+        created_cnt += len(new_rows)
+        for row in new_rows:
+            print(f"Got new article: {row['name']} -- {row['title']}")
 
-        processed_cnt += 1
-        created_cnt += int(created)
-        if created:
-            print(f"Got new article: {name} -- {title}")
+    # 文章全部写入数据库后才保存检查点，写入失败时下次会重新获取这些消息
+    if incremental:
+        client.commit_checkpoints()
 
     DATABASE.close()
     print(f"[{datetime.datetime.now()}] Got {created_cnt} new articles")
@@ -138,9 +155,20 @@ def fetch_wx_articles(name, date, limit, verbose):
 @click.option("-n", "--name", help="要发送文章所属的微信公众号名称")
 @click.option("-l", "--limit", type=int)
 @click.option("--send-all", is_flag=True)
-def send_wx_articles(name, limit, send_all):
+@click.option("-w", "--workers", type=int, default=4, help="发送线程数量")
+@click.option("--rate", type=float, default=0, help="每个 webhook 每秒最多发送数，0 为不限制")
+@click.option("--unordered", is_flag=True, help="不保证同一 webhook 按时间顺序发送")
+def send_wx_articles(name, limit, send_all, workers, rate, unordered):
     """将微信公众号发送到 Huginn"""
-    from zs.rss.models import DATABASE, WechatArticle, WechatArticleSentHistory
+    from zs.rss.dispatcher import Dispatcher
+    from zs.rss.models import (
+        DATABASE,
+        HUGINN_DEST,
+        Outbox,
+        WechatArticle,
+        WechatArticleSentHistory,
+    )
+    from zs.rss.sender import create_session
 
     config = RSSConfigManager()
     webhooks = config.huginn_webhooks
@@ -154,36 +182,47 @@ def send_wx_articles(name, limit, send_all):
 
     DATABASE.connect()
     sent_cnt = 0
-    for article in WechatArticle.search_by_name(name, limit):
-        if not send_all and WechatArticleSentHistory.is_sent(article.url):
-            continue
-
-        webhook_url = webhooks.get(article.name) or webhooks.get("default")
-        if not webhook_url:
-            continue
-
-        if config.proxy:
-            response = requests.post(webhook_url, json=article.to_dict(), proxies=config.proxy)
-        else:
-            response = requests.post(webhook_url, json=article.to_dict())
-
-        if not response:
-            continue
-        if response.status_code in (200, 201):
+    session = create_session(proxy=config.proxy)
+    status = "all" if send_all else "unsent"
+    skip_deferred = not send_all
+    if limit:
+        articles = WechatArticle.search_by_name(
+            name, limit, status=status, skip_deferred=skip_deferred
+        )
+    else:
+        articles = WechatArticle.iter_by_name(name, status=status, skip_deferred=skip_deferred)
+
+    # 逐篇生成待发送的文章，由 Dispatcher 按需读取，不需要一次性载入所有文章
+    items = (
+        (article, webhooks.get(article.name) or webhooks.get("default")) for article in articles
+    )
+    items = (item for item in items if item[1])
+
+    def send(item):
+        article, webhook_url = item
+        return session.post(webhook_url, json=article.to_dict(), timeout=30)
+
+    dispatcher = Dispatcher(workers=workers, rate=rate, ordered=not unordered)
+    for result in dispatcher.dispatch(items, send, key=lambda item: item[1]):
+        article, _ = result.item
+        if result.ok:
             click.secho(
                 f"[{datetime.datetime.now()}] sent article successfully - "
                 f"name: {article.name}; title: {article.title}",
                 fg="green",
             )
-            WechatArticleSentHistory.create(url=article.url)
+            WechatArticleSentHistory.mark_sent(article.url)
+            Outbox.record_success(article.url, HUGINN_DEST)
             sent_cnt += 1
-        else:
+        elif result.failed:
+            item = Outbox.record_failure(article.url, HUGINN_DEST, result.reason)
             click.secho(
                 f"[{datetime.datetime.now()}] failed to send article:"
-                f" {article.name}; title: {article.title}",
+                f" {article.name}; title: {article.title}; {format_outbox_item(item)}",
                 fg="red",
             )
 
+    session.close()
     click.secho(f"[{datetime.datetime.now()}] sent {sent_cnt} articles", fg="green")
     DATABASE.close()
 
@@ -191,37 +230,63 @@ def send_wx_articles(name, limit, send_all):
 @main.command("add-wx-articles")
 @click.option("-n", "--name")
 @click.option("-i", "--infile", required=True)
-def add_wx_articles(name, infile):
+@click.option(
+    "-f",
+    "--format",
+    "input_format",
+    type=click.Choice(["json", "jsonl"]),
+    help="输入文件格式，不设置时根据文件后缀判断，.jsonl 为每行一篇文章",
+)
+@click.option("-b", "--batch-size", type=int, default=1000, help="每个事务写入的文章数量")
+@click.option("--report-every", type=int, default=10000, help="每处理多少篇文章输出一次进度")
+def add_wx_articles(name, infile, input_format, batch_size, report_every):
     """从 json 文件中添加微信公众号文章和发送记录"""
-    from zs.rss.models import DATABASE, WechatArticle, WechatArticleSentHistory
-
-    DATABASE.connect()
-    new_articles_cnt, new_sent = 0, 0
-    with open(infile) as f:
-        for _, item in json.load(f).items():
-            if name and item["name"] != name:
-                continue
-
-            _, created = WechatArticle.get_or_create(
-                name=item["name"],
-                title=item["title"],
-                description=item["desc"],
-                url=item["url"],
-                date=parser.parse(item["date"]),
-            )
-            new_articles_cnt += int(created)
+    from zs.rss.models import DATABASE, WechatArticle
+    from zs.utils import iter_json_lines, iter_json_object
 
-            if item.get("sent") and not WechatArticleSentHistory.is_sent(item["url"]):
-                WechatArticleSentHistory.create(url=item["url"])
-                new_sent += 1
+    if not input_format:
+        input_format = "jsonl" if infile.endswith((".jsonl", ".ndjson")) else "json"
 
-            if created and new_articles_cnt % 100 == 0:
-                print(f"[{datetime.datetime.now()}] Got {new_articles_cnt} new articles")
+    def iter_items():
+        # 边读边解析，文件再大也只在内存中保留当前的一批文章
+        with open(infile) as f:
+            if input_format == "jsonl":
+                items = iter_json_lines(f)
+            else:
+                items = (item for _, item in iter_json_object(f))
+
+            for item in items:
+                if name and item["name"] != name:
+                    continue
+
+                yield {
+                    "name": item["name"],
+                    "title": item["title"],
+                    "description": item["desc"],
+                    "url": item["url"],
+                    "date": parse_date(item["date"]),
+                    "sent": item.get("sent"),
+                }
+
+    def report():
+        print(
+            f"[{datetime.datetime.now()}] Processed {processed} articles, "
+            f"got {new_articles_cnt} new articles and {new_sent} new sent records"
+        )
 
-            if new_sent % 100 == 0:
-                print(f"[{datetime.datetime.now()}] Got {new_articles_cnt} new sent records")
+    DATABASE.connect()
+    processed, reported, new_articles_cnt, new_sent = 0, 0, 0, 0
+    for batch_cnt, new_rows, sent in WechatArticle.bulk_ingest(iter_items(), batch_size):
+        processed += batch_cnt
+        new_articles_cnt += len(new_rows)
+        new_sent += sent
+        if processed - reported >= report_every:
+            reported = processed
+            report()
 
     DATABASE.close()
+    if processed != reported or not processed:
+        report()
 
 
 @main.command("gen-wx-scenario")
@@ -263,6 +328,8 @@ def gen_daily_scenario(feed_url, name, description, outfile):
 @click.option("-f", "--feed-url", required=True)
 def add_feed(name, feed_url):
     """添加 RSS Feed 到数据库"""
+    import feedparser
+
     from zs.rss.models import Feed
 
     if Feed.get_or_none(Feed.feed_link == feed_url):
@@ -284,6 +351,8 @@ def add_feed(name, feed_url):
 @main.command("list-feeds")
 def list_feeds():
     """列出当前的 RSS Feed"""
+    from tabulate import tabulate
+
     from zs.rss.models import Feed
 
     data = []
@@ -295,40 +364,65 @@ def list_feeds():
 
 @main.command("fetch-rss")
 @click.option("-n", "--names", required=True, help="feed 名字")
-def fetch_rss_articles(names):
+@click.option("-w", "--workers", type=int, default=8, help="并发获取的线程数量")
+@click.option("--host-limit", type=int, default=2, help="同一域名的最大并发请求数")
+@click.option(
+    "--timeout", type=float, default=30, help="单个 feed 从发起请求到下载完成的最长时间（秒）"
+)
+@click.option("--force", is_flag=True, help="忽略 ETag/Last-Modified，强制重新获取")
+def fetch_rss_articles(names, workers, host_limit, timeout, force):
     """获取 RSS 并写入数据库中"""
-    from zs.rss.models import Article, Feed
+    from tabulate import tabulate
+
+    from zs.rss.fetcher import FeedFetcher
+    from zs.rss.models import DATABASE, Article, Feed
 
     names = [n.strip() for n in names.split(",") if n.strip()]
-    created_cnt = 0
+    feeds = []
     for name in names:
         feed = Feed.get_or_none(Feed.name == name)
         if not feed:
             click.secho(f"Feed is not found: {name}", fg="red")
             return -1
 
-        feed_url = feed.feed_link
-        feed_data = feedparser.parse(feed_url)
-        for entry in feed_data["entries"]:
-            publish_date = None
-            if entry.get("published_parsed"):
-                publish_date = datetime.datetime.fromtimestamp(
-                    mktime(entry.get("published_parsed"))
-                )
-            else:
-                publish_date = datetime.datetime.now()
-
-            query = Article.select().where(Article.link == entry["link"])
-            if not query.exists():
-                Article.create(
-                    title=entry["title"],
-                    link=entry["link"],
-                    summary=entry.get("summary") or entry.get("content") or "",
-                    feed=feed,
-                    publish_date=publish_date,
-                )
-                created_cnt += 1
+        feeds.append(feed)
 
+    created_cnt, summary = 0, []
+    fetcher = FeedFetcher(
+        workers=workers, host_limit=host_limit, timeout=timeout, conditional=not force
+    )
+    for result in fetcher.fetch_all(feeds):
+        if result.ok:
+            # 条目写入失败时不能保存新的 ETag/Last-Modified，否则下次请求会返回 304，
+            # 这些条目就再也获取不到了，因此两者在同一个事务中完成
+            with DATABASE.atomic():
+                # 304 时没有条目，不需要写入
+                if result.entries:
+                    result.created = Article.bulk_ingest(result.feed, result.entries)
+
+                result.feed.etag = result.etag
+                result.feed.last_modified = result.last_modified
+                result.feed.last_fetched = datetime.datetime.now()
+                result.feed.save(only=[Feed.etag, Feed.last_modified, Feed.last_fetched])
+
+        created_cnt += result.created
+        summary.append(
+            [
+                result.feed.name,
+                result.status,
+                f"{result.latency:.2f}s",
+                len(result.entries),
+                result.created,
+            ]
+        )
+
+    print(
+        tabulate(
+            summary,
+            headers=["name", "status", "latency", "entries", "new"],
+            tablefmt="pretty",
+        )
+    )
     click.secho(f"fetched {created_cnt} new articles")
 
 
@@ -337,18 +431,64 @@ def fetch_rss_articles(names):
 @click.option("-s", "--status", type=click.Choice(["sent", "unsent", "all"]), default="all")
 @click.option("-d", "--sent-dest")
 @click.option("-l", "--limit", type=int)
-def list_articles(name, status, sent_dest, limit):
+@click.option("--offset", type=int, help="跳过最近的若干篇文章，需与 --limit 一起使用")
+def list_articles(name, status, sent_dest, limit, offset):
     """列出当前获取到的微信公众号文章"""
-    from zs.rss.models import Article, SentHistory
+    from zs.rss.models import Article
+
+    if limit:
+        articles = Article.search_by_feed(
+            name, limit=limit, status=status, dest=sent_dest, offset=offset
+        )
+        rows = ((article.publish_date, article.feed.name, article.title) for article in articles)
+    else:
+        articles = Article.iter_by_feed(name, status=status, dest=sent_dest, row_type="dicts")
+        rows = (
+            (article["publish_date"], article["feed_name"], article["title"])
+            for article in articles
+        )
+
+    for publish_date, feed_name, title in rows:
+        title = title if len(title) <= 30 else title[:30] + "..."
+        print(f"[{publish_date}] {feed_name} -- {title}")
+
+
+@main.command("search")
+@click.argument("keywords", nargs=-1, required=True)
+@click.option("-k", "--kind", type=click.Choice(["rss", "wechat", "all"]), default="all")
+@click.option("-n", "--name", help="订阅源或微信公众号名称")
+@click.option("--since", help="只查找该日期及之后的文章，格式为 YYYY-MM-DD")
+@click.option("--until", help="只查找该日期及之前的文章，格式为 YYYY-MM-DD")
+@click.option("-l", "--limit", type=int, default=20)
+def search(keywords, kind, name, since, until, limit):
+    """在 RSS 条目和微信公众号文章的标题、摘要中搜索关键词，结果按相关度排序"""
+    from zs.rss.models import DATABASE, SearchIndex
+
+    start = since and datetime.datetime.strptime(since, "%Y-%m-%d").date()
+    end = until and datetime.datetime.strptime(until, "%Y-%m-%d").date() + datetime.timedelta(1)
+
+    DATABASE.connect()
+    if not SearchIndex.table_exists():
+        click.secho(
+            "search index is not found, please run `zs-rss migrate` first"
+            " (requires SQLite with FTS5)",
+            fg="red",
+        )
+        DATABASE.close()
+        return -1
 
-    for article in Article.search_by_feed(name, limit=limit):
-        if (
-            status == "all"
-            or (status == "sent" and SentHistory.is_sent(article.link, dest=sent_dest))
-            or (status == "unsent" and not SentHistory.is_sent(article.link))
-        ):
-            title = article.title if len(article.title) <= 30 else article.title[:30] + "..."
-            print(f"[{article.publish_date}] {article.feed.name} -- {title}")
+    results = SearchIndex.search(
+        " ".join(keywords),
+        kind=None if kind == "all" else kind,
+        source=name,
+        start=start,
+        end=end,
+        limit=limit,
+    )
+    for result in results:
+        print(f"[{result.date}] {result.source} -- {result.title}\n    {result.url}")
+
+    DATABASE.close()
 
 
 @main.command("send-articles")
@@ -356,8 +496,12 @@ def list_articles(name, status, sent_dest, limit):
 @click.option("-l", "--limit", type=int)
 @click.option("--dest-type", required=True)
 @click.option("--send-all", is_flag=True)
-def send_articles(name, limit, dest_type, send_all):
-    from zs.rss.models import Article, SentHistory
+@click.option("-w", "--workers", type=int, default=4, help="发送线程数量")
+@click.option("--rate", type=float, default=1.0, help="每秒最多发送的文章数，0 表示不限制")
+@click.option("--unordered", is_flag=True, help="不保证按时间顺序发送")
+def send_articles(name, limit, dest_type, send_all, workers, rate, unordered):
+    from zs.rss.dispatcher import Dispatcher
+    from zs.rss.models import Article, Outbox, SentHistory
     from zs.rss.sender import get_sender_cls
 
     sent_cnt = 0
@@ -376,27 +520,86 @@ def send_articles(name, limit, dest_type, send_all):
         )
         return -1
 
+    sender_config = dict(sender_config)
+    sender_config.setdefault("proxy", config.proxy)
     sender = sender_cls(**sender_config)
-    for article in Article.search_by_feed(name, limit):
-        if not send_all and SentHistory.is_sent(article.link, dest_type):
-            continue
-
-        response = sender.send(article)
-        if not response:
-            continue
-        if response.status_code in (200, 201):
+    status = "all" if send_all else "unsent"
+    if limit:
+        articles = Article.search_by_feed(
+            name, limit, status=status, dest=dest_type, skip_deferred=not send_all
+        )
+    else:
+        articles = Article.iter_by_feed(
+            name, status=status, dest=dest_type, skip_deferred=not send_all
+        )
+    dispatcher = Dispatcher(workers=workers, rate=rate, ordered=not unordered)
+    for result in dispatcher.dispatch(articles, sender.send, key=lambda _: sender.dest_url):
+        article = result.item
+        if result.ok:
             click.secho(
                 f"[{datetime.datetime.now()}] sent article successfully - "
                 f"name: {article.feed.name}; title: {article.title}",
                 fg="green",
             )
-            SentHistory.create(url=article.link, dest=dest_type)
+            SentHistory.mark_sent(article.link, dest_type)
+            Outbox.record_success(article.link, dest_type)
             sent_cnt += 1
-        else:
+        elif result.failed:
+            item = Outbox.record_failure(article.link, dest_type, result.reason)
             click.secho(
                 f"[{datetime.datetime.now()}] failed to send article:"
-                f" {article.feed.name}; title: {article.title}",
+                f" {article.feed.name}; title: {article.title}; {format_outbox_item(item)}",
                 fg="red",
             )
 
+    sender.close()
     click.secho(f"[{datetime.datetime.now()}] sent {sent_cnt} articles", fg="green")
+
+
+def format_outbox_item(item):
+    if item.status == item.DEAD:
+        return f"moved to dead letters after {item.attempts} attempts ({item.last_error})"
+
+    return f"attempt {item.attempts}, will retry after {item.next_attempt} ({item.last_error})"
+
+
+@main.command("list-outbox")
+@click.option("-s", "--status", type=click.Choice(["pending", "dead", "all"]), default="all")
+@click.option("-d", "--dest", help="发送目标，微信公众号文章为 huginn")
+def list_outbox(status, dest):
+    """列出发送失败等待重试或已进入死信状态的文章"""
+    from tabulate import tabulate
+
+    from zs.rss.models import Outbox
+
+    query = Outbox.select().order_by(Outbox.created)
+    if status != "all":
+        query = query.where(Outbox.status == status)
+    if dest:
+        query = query.where(Outbox.dest == dest)
+
+    data = [
+        [
+            item.id,
+            item.dest,
+            item.status,
+            item.attempts,
+            item.next_attempt,
+            item.last_error,
+            item.url,
+        ]
+        for item in query
+    ]
+    headers = ["id", "dest", "status", "attempts", "next attempt", "last error", "url"]
+    print(tabulate(data, headers=headers, tablefmt="pretty"))
+
+
+@main.command("replay-outbox")
+@click.option("-d", "--dest", help="只重放该发送目标的死信，微信公众号文章为 huginn")
+@click.option("-i", "--ids", multiple=True, type=int, help="只重放指定 id 的死信")
+def replay_outbox(dest, ids):
+    """将死信重新放回发送队列，下次发送时立即重试"""
+    from zs.rss.models import Outbox
+
+    replayed = Outbox.replay(dest=dest, ids=ids)
+    click.secho(f"[{datetime.datetime.now()}] replayed {replayed} dead letters", fg="green")
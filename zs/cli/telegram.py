@@ -1,12 +1,10 @@
 import datetime
 import json
+import re
+import time
 from logging.config import dictConfig
 
 import click
-from dateutil import tz
-from telethon import sync  # noqa
-
-from zs.telegram import TelegramClient
 
 dictConfig(
     {
@@ -46,8 +44,35 @@ def main():
 @click.option("-o", "--outfile", required=True)
 @click.option("-t", "--message-type")
 @click.option("-v", "--verbose", is_flag=True)
-def fetch_msgs(name, begin_date, end_date, offset_id, limit, outfile, message_type, verbose):
+@click.option("--incremental", is_flag=True, help="只获取上次获取之后的新消息")
+@click.option(
+    "-f",
+    "--format",
+    "output_format",
+    type=click.Choice(["json", "jsonl"]),
+    default="json",
+    help=(
+        "json 格式按时间从旧到新排列；jsonl 格式下每获取一条消息就写入一行，不在内存中保存"
+        "全部消息，按时间从新到旧排列（增量获取且已有检查点时从旧到新）"
+    ),
+)
+def fetch_msgs(
+    name,
+    begin_date,
+    end_date,
+    offset_id,
+    limit,
+    outfile,
+    message_type,
+    verbose,
+    incremental,
+    output_format,
+):
     """获取某个聊天的消息记录"""
+    from dateutil import tz
+
+    from zs.telegram import TelegramClient
+
     client = TelegramClient()
 
     start = datetime.datetime.strptime(begin_date, "%Y-%m-%d")
@@ -56,17 +81,167 @@ def fetch_msgs(name, begin_date, end_date, offset_id, limit, outfile, message_ty
     end = datetime.datetime.strptime(end_date, "%Y-%m-%d")
     end = end.replace(tzinfo=tz.tzlocal()).astimezone(datetime.timezone.utc)
 
-    messages = [
-        msg.to_dict()
-        for msg in client.fetch_messages(
-            name,
-            start=start,
-            end=end,
-            limit=limit,
-            offset_id=offset_id,
-            msg_type=message_type,
-            verbose=verbose,
-        )
-    ]
-    with open(outfile, "w") as fout:
-        json.dump(messages, fout, ensure_ascii=False, indent=4)
+    options = dict(
+        start=start,
+        end=end,
+        limit=limit,
+        offset_id=offset_id,
+        msg_type=message_type,
+        verbose=verbose,
+        incremental=incremental,
+    )
+    if output_format == "jsonl":
+        # 行缓冲，每写完一行就刷到文件中，中断时已写入的消息仍然可用
+        with open(outfile, "w", buffering=1) as fout:
+            for msg in client.iter_messages(name, **options):
+                fout.write(json.dumps(msg.to_dict(), ensure_ascii=False) + "\n")
+    else:
+        messages = [msg.to_dict() for msg in client.fetch_messages(name, **options)]
+        with open(outfile, "w") as fout:
+            json.dump(messages, fout, ensure_ascii=False, indent=4)
+
+    # 消息全部写入文件后才保存检查点，中断或出错时下次会重新获取这些消息
+    if incremental:
+        client.commit_checkpoints()
+
+
+@main.command("bench-ignore")
+@click.option("-n", "--size", type=int, default=100000, help="合成消息的数量")
+def bench_ignore(size):
+    """测试消息忽略规则的匹配性能"""
+    from zs.telegram import (
+        DEFAULT_IGNORED_MSG_PATTERNS,
+        TelegramConfigManager,
+        compile_ignored_patterns,
+    )
+    from zs.telegram_replay import generate_message_corpus
+
+    patterns = TelegramConfigManager().ignored_patterns
+    corpus = generate_message_corpus(size)
+
+    compiled = [re.compile(pattern) for pattern in patterns]
+    begin = time.perf_counter()
+    expected = [any(pat.findall(text) for pat in compiled) for text in corpus]
+    baseline = time.perf_counter() - begin
+
+    rules = compile_ignored_patterns(patterns)
+    begin = time.perf_counter()
+    result = [rules is not None and rules.search(text) for text in corpus]
+    elapsed = time.perf_counter() - begin
+
+    if result != expected:
+        click.secho("results of the compiled rules differ from the original rules", fg="red")
+        return -1
+
+    default = " (default)" if patterns == DEFAULT_IGNORED_MSG_PATTERNS else ""
+    click.echo(f"{size} messages, {sum(result)} ignored, {len(patterns)} rules{default}")
+    click.echo(f"per-rule findall:  {baseline:.3f}s ({size / baseline:.0f} msgs/s)")
+    click.echo(f"compiled rules:    {elapsed:.3f}s ({size / elapsed:.0f} msgs/s)")
+
+
+@main.command("dump-fixtures")
+@click.option("-n", "--name", required=True, help="聊天名称，可为群组、频道、用户名")
+@click.option("--begin-date", default=str(datetime.date.today()))
+@click.option("--end-date", default=str(datetime.date.today() + datetime.timedelta(days=1)))
+@click.option("-l", "--limit", type=int, default=100)
+@click.option("-o", "--outfile", required=True)
+def dump_fixtures(name, begin_date, end_date, limit, outfile):
+    """将某个聊天的原始消息保存为 JSON Lines 格式的样本，用于离线重放"""
+    from dateutil import tz
+
+    from zs.telegram import TelegramClient
+    from zs.telegram_replay import dump_message, save_fixtures
+
+    client = TelegramClient()
+
+    start = datetime.datetime.strptime(begin_date, "%Y-%m-%d")
+    start = start.replace(tzinfo=tz.tzlocal()).astimezone(datetime.timezone.utc)
+
+    end = datetime.datetime.strptime(end_date, "%Y-%m-%d")
+    end = end.replace(tzinfo=tz.tzlocal()).astimezone(datetime.timezone.utc)
+
+    # 保存未经过滤和解析的原始消息，重放时被忽略的消息和无内容的消息也会经过完整的解析流程
+    messages = client.iter_raw_messages(name, start=start, end=end, limit=limit)
+    records = (
+        dump_message(message, sender=getattr(message.sender, "username", None))
+        for message in messages
+    )
+    count = save_fixtures(records, outfile)
+    click.secho(f"saved {count} messages to {outfile}", fg="green")
+
+
+@main.command("replay-msgs")
+@click.option("-i", "--infile", required=True, help="dump-fixtures 保存的样本文件")
+@click.option("-o", "--outfile")
+@click.option("-g", "--golden", help="之前用 replay-msgs 保存的解析结果，用于检查解析结果是否一致")
+def replay_msgs(infile, outfile, golden):
+    """离线解析样本文件中的消息，输出格式与 fetch-msgs 的 jsonl 格式一致"""
+    from zs.telegram import TelegramConfigManager, compile_ignored_patterns
+    from zs.telegram_replay import load_fixtures, replay_messages
+
+    if not outfile and not golden:
+        raise click.UsageError("at least one of --outfile and --golden is required")
+
+    config = TelegramConfigManager()
+    fout = open(outfile, "w") if outfile else None
+    fgolden = open(golden) if golden else None
+    total, mismatched = 0, 0
+    try:
+        ignore_rules = compile_ignored_patterns(config.ignored_patterns)
+        messages = replay_messages(load_fixtures(infile), config=config, ignore_rules=ignore_rules)
+        for msg in messages:
+            data = msg.to_dict()
+            total += 1
+            if fout:
+                fout.write(json.dumps(data, ensure_ascii=False) + "\n")
+            if fgolden:
+                line = fgolden.readline()
+                # 经过一次 JSON 序列化，与文件中读出的结果比较时不受元组等类型的影响
+                if not line or json.loads(line) != json.loads(json.dumps(data)):
+                    mismatched += 1
+                    if mismatched <= 10:
+                        click.secho(f"message {data['id']} differs from golden output", fg="red")
+
+        # 解析结果比之前少时，多出来的每条结果都算作不一致
+        if fgolden:
+            missing = sum(1 for line in fgolden if line.strip())
+            if missing:
+                mismatched += missing
+                click.secho(f"{missing} golden messages are missing from replay", fg="red")
+    finally:
+        for fobj in (fout, fgolden):
+            if fobj:
+                fobj.close()
+
+    if golden:
+        color = "red" if mismatched else "green"
+        click.secho(f"{total} messages replayed, {mismatched} differ from {golden}", fg=color)
+        if mismatched:
+            return -1
+
+
+@main.command("bench-parse")
+@click.option("-i", "--infile", help="样本文件，不设置时使用合成样本")
+@click.option("-n", "--size", type=int, default=60000, help="合成样本的数量")
+@click.option("-r", "--repeat", type=int, default=3, help="重复次数，取最快的一次")
+def bench_parse(infile, size, repeat):
+    """按消息类型测试消息解析的速度"""
+    from tabulate import tabulate
+
+    from zs.telegram_replay import (
+        ReplayMessage,
+        benchmark_parse,
+        generate_fixtures,
+        load_fixtures,
+    )
+
+    if infile:
+        messages = list(load_fixtures(infile))
+    else:
+        messages = [ReplayMessage(record) for record in generate_fixtures(size)]
+
+    rows = []
+    for msg_type, count, elapsed in benchmark_parse(messages, repeat=repeat):
+        rows.append((msg_type.name, count, f"{elapsed:.3f}", f"{count / elapsed:.0f}"))
+
+    click.echo(tabulate(rows, headers=["type", "messages", "seconds", "msgs/s"]))
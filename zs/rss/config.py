@@ -7,6 +7,16 @@ DEFAULT_CONFIG_FILE = os.path.join(CONFIG_DIR, "rss.json")
 
 
 class RSSConfigManager:
+    # 适合抓取与发送任务并发执行的默认设置：WAL 模式下读写互不阻塞，
+    # 写锁冲突时最多等待 busy_timeout 毫秒而不是直接报 "database is locked"
+    DEFAULT_SQLITE_PRAGMAS = {
+        "journal_mode": "wal",
+        "synchronous": "normal",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "busy_timeout": 10000,
+    }
+
     def __init__(self, config_file=DEFAULT_CONFIG_FILE):
         self.config_file = config_file
         self.data = {}
@@ -33,3 +43,9 @@ class RSSConfigManager:
     @property
     def senders(self):
         return self.data.get("senders", {})
+
+    @property
+    def sqlite_pragmas(self):
+        pragmas = dict(self.DEFAULT_SQLITE_PRAGMAS)
+        pragmas.update(self.data.get("sqlite_pragmas", {}))
+        return pragmas
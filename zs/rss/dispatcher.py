@@ -0,0 +1,191 @@
+import datetime
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+
+LOGGER = logging.getLogger(__name__)
+
+
+def parse_retry_after(value, default=1.0):
+    """解析 Retry-After 头，支持秒数和 HTTP 日期两种格式，返回需要等待的秒数"""
+    if not value:
+        return default
+
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+
+    now = datetime.datetime.now(retry_at.tzinfo or datetime.timezone.utc)
+    return max((retry_at - now).total_seconds(), 0.0)
+
+
+class RateLimiter:
+    """按目标限制发送频率，每个目标每秒最多发送 rate 条消息
+
+    rate 不大于 0 时不做限制
+    """
+
+    def __init__(self, rate=1.0):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0.0
+        self._next_allowed = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, key):
+        with self._lock:
+            now = time.monotonic()
+            allowed = max(self._next_allowed.get(key, now), now)
+            self._next_allowed[key] = allowed + self.interval
+
+        if allowed > now:
+            time.sleep(allowed - now)
+
+    def pause(self, key, delay):
+        """目标要求暂停发送（如返回 429）时，将其下一次可发送时间推迟 delay 秒"""
+        with self._lock:
+            resume = time.monotonic() + delay
+            self._next_allowed[key] = max(self._next_allowed.get(key, resume), resume)
+
+
+class DispatchResult:
+    """单条消息的发送结果"""
+
+    def __init__(self, item, response=None, error=None, attempts=1):
+        self.item = item
+        self.response = response
+        self.error = error
+        self.attempts = attempts
+
+    @property
+    def ok(self):
+        return self.response is not None and self.response.status_code in (200, 201)
+
+    @property
+    def failed(self):
+        return self.error is not None or (self.response is not None and not self.ok)
+
+    @property
+    def reason(self):
+        if self.error is not None:
+            return str(self.error)
+        if self.response is not None:
+            return f"HTTP {self.response.status_code}"
+        return ""
+
+
+class Dispatcher:
+    """并发发送消息，同时对每个目标限速
+
+    Parameters
+    ----------
+    workers: int
+        发送线程数量
+    rate: float
+        每个目标每秒最多发送的消息数量，Slack incoming webhook 约为 1 条/秒
+    ordered: bool
+        是否保证同一目标的消息按传入顺序逐条发送，为 True 时同一目标的消息
+        由同一个线程依次发送，并发只发生在不同目标之间
+    max_retries: int
+        遇到 429 时的最大重试次数
+    max_pending: int
+        已读取但尚未返回结果的消息的最大数量，达到上限时暂停读取输入，
+        默认为 workers 的 32 倍
+    """
+
+    def __init__(self, workers=4, rate=1.0, ordered=True, max_retries=5, max_pending=None):
+        self.workers = workers
+        self.ordered = ordered
+        self.max_retries = max_retries
+        self.max_pending = max_pending or max(workers, 1) * 32
+        self.limiter = RateLimiter(rate)
+
+    def send_one(self, item, send, key):
+        attempts = 0
+        while True:
+            attempts += 1
+            self.limiter.acquire(key)
+            try:
+                response = send(item)
+            except Exception as exc:  # noqa
+                LOGGER.exception("failed to send item to %s", key)
+                return DispatchResult(item, error=exc, attempts=attempts)
+
+            if response is None or response.status_code != 429 or attempts > self.max_retries:
+                return DispatchResult(item, response=response, attempts=attempts)
+
+            delay = parse_retry_after(response.headers.get("Retry-After"))
+            LOGGER.info("rate limited by %s, retry after %.1f seconds", key, delay)
+            self.limiter.pause(key, delay)
+
+    def _send(self, item, send, dest, results):
+        results.put(self.send_one(item, send, dest))
+
+    def _drain(self, dest, queues, lock, send, results):
+        """依次发送某个目标队列中的消息，队列为空时移除该队列，之后的消息会重新提交"""
+        while True:
+            with lock:
+                if not queues[dest]:
+                    del queues[dest]
+                    return
+
+                item = queues[dest].popleft()
+
+            self._send(item, send, dest, results)
+
+    def dispatch(self, items, send, key):
+        """发送所有消息，按完成顺序逐个返回 DispatchResult
+
+        输入在调用方的线程中按需读取，同时最多只有 max_pending 条消息在内存中等待发送，
+        items 可以是逐页查询数据库的生成器
+
+        Parameters
+        ----------
+        items: iterable
+            待发送的消息
+        send: callable
+            发送单条消息的函数，返回 requests.Response 或 None（表示无需发送）
+        key: callable
+            返回消息所属目标的函数，限速和保序都以目标为单位
+        """
+        results = queue.Queue()
+        # 保序模式下每个目标一个队列，同一时刻只有一个线程在发送某个目标的消息
+        queues, lock = {}, threading.Lock()
+        pending = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for item in items:
+                while pending >= self.max_pending:
+                    pending -= 1
+                    yield results.get()
+
+                dest = key(item)
+                if not self.ordered:
+                    executor.submit(self._send, item, send, dest, results)
+                else:
+                    with lock:
+                        idle = dest not in queues
+                        queues.setdefault(dest, deque()).append(item)
+                    if idle:
+                        executor.submit(self._drain, dest, queues, lock, send, results)
+
+                pending += 1
+                # 已完成的结果立即返回，调用方可以边发送边记录发送状态
+                while pending:
+                    try:
+                        result = results.get_nowait()
+                    except queue.Empty:
+                        break
+
+                    pending -= 1
+                    yield result
+
+            for _ in range(pending):
+                yield results.get()
@@ -0,0 +1,192 @@
+import datetime
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from itertools import zip_longest
+from time import mktime
+from urllib.parse import urlparse
+
+import feedparser
+import requests
+
+LOGGER = logging.getLogger(__name__)
+
+
+def parse_entry(entry):
+    """将 feedparser 解析得到的条目转换为 Article 所需的字段"""
+    if entry.get("published_parsed"):
+        publish_date = datetime.datetime.fromtimestamp(mktime(entry.get("published_parsed")))
+    else:
+        publish_date = datetime.datetime.now()
+
+    return {
+        "title": entry["title"],
+        "link": entry["link"],
+        "summary": entry.get("summary") or entry.get("content") or "",
+        "publish_date": publish_date,
+    }
+
+
+def read_content(response, deadline):
+    """在截止时间之前读取响应内容，超时后关闭连接，使阻塞中的读取立即失败
+
+    requests 的 timeout 只限制单次读取的等待时间，持续缓慢返回数据的服务端可以让读取远远超过
+    该时间，因此需要单独限制整个下载过程
+    """
+    expired = threading.Event()
+
+    def abort():
+        expired.set()
+        # 连接可能已交给响应对象独占，只能通过文件描述符找到底层的 socket
+        try:
+            with socket.socket(fileno=os.dup(response.raw.fileno())) as sock:
+                sock.shutdown(socket.SHUT_RDWR)
+        except (OSError, ValueError):
+            pass
+
+    timer = threading.Timer(max(deadline - time.time(), 0.0), abort)
+    timer.start()
+    try:
+        return response.content
+    except requests.RequestException:
+        if expired.is_set():
+            raise requests.Timeout("feed download exceeded the deadline")
+        raise
+    finally:
+        # 等待可能正在执行的 abort 结束，避免响应关闭后再操作其文件描述符
+        timer.cancel()
+        timer.join()
+
+
+class FetchResult:
+    """单个订阅源的获取结果"""
+
+    def __init__(
+        self,
+        feed,
+        entries=None,
+        latency=0.0,
+        error=None,
+        not_modified=False,
+        etag=None,
+        last_modified=None,
+    ):
+        self.feed = feed
+        self.entries = entries or []
+        self.latency = latency
+        self.error = error
+        self.not_modified = not_modified
+        self.etag = etag
+        self.last_modified = last_modified
+        self.created = 0
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    @property
+    def status(self):
+        if not self.ok:
+            return "error"
+        if self.not_modified:
+            return "not modified"
+        return "ok"
+
+
+class FeedFetcher:
+    """并发获取多个 RSS 订阅源
+
+    Parameters
+    ----------
+    workers: int
+        工作线程数量，即同时进行中的请求的最大数量
+    host_limit: int
+        对同一个域名同时进行中的请求的最大数量，避免对单个站点造成过大压力
+    timeout: float
+        单个订阅源的超时时间，单位为秒，从发起请求开始计算，到此时仍未下载完成的订阅源会被放弃
+    conditional: bool
+        是否使用订阅源上次返回的 ETag/Last-Modified 发起条件请求，服务端返回
+        304 时将跳过解析
+    """
+
+    def __init__(self, workers=8, host_limit=2, timeout=30, conditional=True):
+        self.workers = workers
+        self.host_limit = host_limit
+        self.timeout = timeout
+        self.conditional = conditional
+        self._host_semaphores = defaultdict(lambda: threading.BoundedSemaphore(self.host_limit))
+        self._lock = threading.Lock()
+
+    def _get_host_semaphore(self, host):
+        with self._lock:
+            return self._host_semaphores[host]
+
+    def fetch(self, feed):
+        """获取单个订阅源，请求和解析中的任何异常都记录在 FetchResult.error 中，不影响其他订阅源"""
+        host = urlparse(feed.feed_link).netloc
+        with self._get_host_semaphore(host):
+            start = time.time()
+            try:
+                return self._fetch(feed, start)
+            except requests.RequestException as exc:
+                LOGGER.warning("failed to fetch feed %s: %s", feed.name, exc)
+                return FetchResult(feed, latency=time.time() - start, error=str(exc))
+            except Exception as exc:  # noqa
+                LOGGER.exception("failed to parse feed %s", feed.name)
+                error = f"{type(exc).__name__}: {exc}"
+                return FetchResult(feed, latency=time.time() - start, error=error)
+
+    def _fetch(self, feed, start):
+        headers = {"User-Agent": feedparser.USER_AGENT}
+        if self.conditional:
+            headers.update(feed.get_validators())
+
+        with requests.get(
+            feed.feed_link, headers=headers, timeout=self.timeout, stream=True
+        ) as response:
+            response.raise_for_status()
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+            if response.status_code == 304:
+                return FetchResult(
+                    feed,
+                    latency=time.time() - start,
+                    not_modified=True,
+                    etag=etag or feed.etag,
+                    last_modified=last_modified or feed.last_modified,
+                )
+
+            headers = {key.lower(): value for key, value in response.headers.items()}
+            headers["content-location"] = response.url
+            content = read_content(response, start + self.timeout)
+            feed_data = feedparser.parse(content, response_headers=headers)
+            entries = [parse_entry(entry) for entry in feed_data["entries"]]
+            return FetchResult(
+                feed,
+                entries=entries,
+                latency=time.time() - start,
+                etag=etag,
+                last_modified=last_modified,
+            )
+
+    @staticmethod
+    def interleave_by_host(feeds):
+        """按域名交错排列订阅源，避免同一域名的请求集中占满工作线程"""
+        groups = defaultdict(list)
+        for feed in feeds:
+            groups[urlparse(feed.feed_link).netloc].append(feed)
+
+        return [
+            feed for batch in zip_longest(*groups.values()) for feed in batch if feed is not None
+        ]
+
+    def fetch_all(self, feeds):
+        """并发获取所有订阅源，按完成顺序逐个返回 FetchResult"""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = [executor.submit(self.fetch, feed) for feed in self.interleave_by_host(feeds)]
+            for future in as_completed(futures):
+                yield future.result()
@@ -1,8 +1,6 @@
 from copy import deepcopy
 from uuid import uuid4
 
-import feedparser
-
 from .consts import (
     DAILY_DIGEST_SCENARIO_TEMPLATE,
     EFB_SCENARIO_TEMPLATE,
@@ -44,6 +42,8 @@ def generate_efb_scenario(name, wxid):
 
 
 def generate_daily_digest_scenario(feed_url, name=None, description=None):
+    import feedparser
+
     result = deepcopy(DAILY_DIGEST_SCENARIO_TEMPLATE)
 
     feed_info = feedparser.parse(feed_url)["feed"]
@@ -0,0 +1,196 @@
+import logging
+import sqlite3
+
+from peewee import fn
+from playhouse.migrate import SqliteMigrator, migrate
+
+from .models import (
+    DATABASE,
+    Article,
+    Feed,
+    Outbox,
+    SearchIndex,
+    SentHistory,
+    WechatArticle,
+    WechatArticleSentHistory,
+)
+
+LOGGER = logging.getLogger(__name__)
+MODELS = [
+    WechatArticle,
+    WechatArticleSentHistory,
+    Feed,
+    Article,
+    SentHistory,
+    Outbox,
+]
+
+
+def add_missing_columns(model):
+    """为已有的表补上模型中新增的字段，新增字段需允许为空或带有默认值"""
+    table = model._meta.table_name
+    columns = {column.name for column in DATABASE.get_columns(table)}
+    operations = []
+    migrator = SqliteMigrator(DATABASE)
+    for field in model._meta.sorted_fields:
+        if field.column_name in columns:
+            continue
+
+        LOGGER.info("add column %s.%s", table, field.column_name)
+        operations.append(migrator.add_column(table, field.column_name, field))
+
+    if operations:
+        migrate(*operations)
+
+    return len(operations)
+
+
+def get_schema_version():
+    return DATABASE.execute_sql("PRAGMA user_version").fetchone()[0]
+
+
+def set_schema_version(version):
+    DATABASE.execute_sql(f"PRAGMA user_version = {int(version)}")
+
+
+def ensure_unique_index(model, columns):
+    """删除重复记录（保留最早的一条），然后将 columns 上的索引替换为唯一索引"""
+    table = model._meta.table_name
+    index_name = "_".join([table] + list(columns))
+    for index in DATABASE.get_indexes(table):
+        if index.name == index_name and index.unique:
+            return
+
+    keep = model.select(fn.MIN(model.id)).group_by(*[getattr(model, c) for c in columns])
+    removed = model.delete().where(model.id.not_in(keep)).execute()
+    if removed:
+        LOGGER.info("removed %d duplicated rows from %s", removed, table)
+
+    migrator = SqliteMigrator(DATABASE)
+    operations = []
+    for index in DATABASE.get_indexes(table):
+        if index.name == index_name or index.columns == [columns[0]]:
+            operations.append(migrator.drop_index(table, index.name))
+
+    operations.append(migrator.add_index(table, columns, unique=True))
+    migrate(*operations)
+
+
+def ensure_index(model, columns):
+    """在 columns 上创建普通索引，已存在同名索引时跳过"""
+    table = model._meta.table_name
+    index_name = "_".join([table] + list(columns))
+    if any(index.name == index_name for index in DATABASE.get_indexes(table)):
+        return
+
+    migrate(SqliteMigrator(DATABASE).add_index(table, columns))
+
+
+def unique_sent_history():
+    """发送记录去重并添加唯一索引，使重复发送的记录写入变成幂等操作"""
+    ensure_unique_index(SentHistory, ("url", "dest"))
+    ensure_unique_index(WechatArticleSentHistory, ("url",))
+
+
+def listing_indexes():
+    """添加按名称/订阅源和时间分页遍历文章所需的索引"""
+    ensure_index(WechatArticle, ("name", "date"))
+    ensure_index(WechatArticle, ("date",))
+    ensure_index(Article, ("feed_id", "publish_date"))
+    ensure_index(Article, ("publish_date",))
+
+
+# 插入或修改文章时写入全文索引，RSS 条目的 rowid 为 id * 2，微信公众号文章为 id * 2 + 1
+ARTICLE_INDEX_SQL = """
+INSERT OR REPLACE INTO searchindex (rowid, title, content, kind, source, url, date)
+SELECT new.id * 2, new.title, new.summary, 'rss', feed.name, new.link, new.publish_date
+FROM feed WHERE feed.id = new.feed_id;
+"""
+WECHAT_ARTICLE_INDEX_SQL = """
+INSERT OR REPLACE INTO searchindex (rowid, title, content, kind, source, url, date)
+VALUES (new.id * 2 + 1, new.title, new.description, 'wechat', new.name, new.url, new.date);
+"""
+SEARCH_INDEX_TRIGGERS = {
+    "article_search_insert": f"AFTER INSERT ON article BEGIN {ARTICLE_INDEX_SQL} END",
+    "article_search_update": f"AFTER UPDATE ON article BEGIN {ARTICLE_INDEX_SQL} END",
+    "article_search_delete": (
+        "AFTER DELETE ON article BEGIN DELETE FROM searchindex WHERE rowid = old.id * 2; END"
+    ),
+    "feed_search_rename": (
+        "AFTER UPDATE OF name ON feed BEGIN UPDATE searchindex SET source = new.name"
+        " WHERE rowid IN (SELECT id * 2 FROM article WHERE feed_id = new.id); END"
+    ),
+    "wechatarticle_search_insert": (
+        f"AFTER INSERT ON wechatarticle BEGIN {WECHAT_ARTICLE_INDEX_SQL} END"
+    ),
+    "wechatarticle_search_update": (
+        f"AFTER UPDATE ON wechatarticle BEGIN {WECHAT_ARTICLE_INDEX_SQL} END"
+    ),
+    "wechatarticle_search_delete": (
+        "AFTER DELETE ON wechatarticle BEGIN"
+        " DELETE FROM searchindex WHERE rowid = old.id * 2 + 1; END"
+    ),
+}
+
+
+def search_index():
+    """创建全文索引和同步触发器，并为已有的文章建立索引，SQLite 不支持 FTS5 时跳过"""
+    if not SearchIndex.fts5_installed():
+        LOGGER.warning("SQLite %s does not support FTS5, skip search index", sqlite3.sqlite_version)
+        return
+
+    SearchIndex.create_table(safe=True)
+    # 标题的权重高于正文，ORDER BY rank 时按该配置计算相关度
+    DATABASE.execute_sql(
+        "INSERT INTO searchindex (searchindex, rank) VALUES ('rank', 'bm25(10.0, 1.0)')"
+    )
+    for name, body in SEARCH_INDEX_TRIGGERS.items():
+        DATABASE.execute_sql(f"CREATE TRIGGER IF NOT EXISTS {name} {body}")
+
+    DATABASE.execute_sql(
+        "INSERT OR REPLACE INTO searchindex (rowid, title, content, kind, source, url, date)"
+        " SELECT article.id * 2, article.title, article.summary, 'rss', feed.name,"
+        " article.link, article.publish_date FROM article JOIN feed ON feed.id = article.feed_id"
+    )
+    DATABASE.execute_sql(
+        "INSERT OR REPLACE INTO searchindex (rowid, title, content, kind, source, url, date)"
+        " SELECT id * 2 + 1, title, description, 'wechat', name, url, date FROM wechatarticle"
+    )
+    LOGGER.info("indexed %d articles for full-text search", SearchIndex.select().count())
+
+
+# 按顺序执行的结构升级，数据库当前版本记录在 `PRAGMA user_version` 中
+MIGRATIONS = [
+    unique_sent_history,
+    listing_indexes,
+    search_index,
+]
+
+
+def migrate_database():
+    """创建缺失的表并将已有的表升级到当前模型的结构
+
+    每个升级步骤在单独的事务中执行并记录版本，某一步失败时之前完成的步骤不会回滚
+
+    Return
+    ------
+    applied: list of str
+        本次执行的升级步骤名称
+    """
+    # 已有的表不能直接 create_tables，否则会在存在重复数据时先行创建唯一索引而失败
+    DATABASE.create_tables([model for model in MODELS if not model.table_exists()])
+    with DATABASE.atomic():
+        for model in MODELS:
+            add_missing_columns(model)
+
+    applied = []
+    version = get_schema_version()
+    for idx, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        LOGGER.info("apply migration %d: %s", idx, migration.__name__)
+        with DATABASE.atomic():
+            migration()
+            set_schema_version(idx)
+
+        applied.append(migration.__name__)
+
+    return applied
@@ -1,21 +1,41 @@
 import datetime
 import os
+import random
+import sqlite3
+from operator import attrgetter, itemgetter
 
 from peewee import (
+    SQL,
     AutoField,
     CharField,
     DateTimeField,
     ForeignKeyField,
+    IntegerField,
     Model,
     SqliteDatabase,
     TextField,
+    chunked,
+    fn,
 )
+from playhouse.sqlite_ext import FTS5Model, RowIDField, SearchField
+
+from .config import RSSConfigManager
 
 DB_DIR = os.path.join(os.environ.get("HOME"), ".zs/data/db")
-if not os.path.exists(DB_DIR):
-    os.makedirs(DB_DIR)
 
-DATABASE = SqliteDatabase(os.path.join(DB_DIR, "rss.db"))
+
+class RSSDatabase(SqliteDatabase):
+    """首次连接时才创建数据库所在的目录，导入本模块时不访问文件系统"""
+
+    def _connect(self):
+        db_dir = os.path.dirname(self.database)
+        if db_dir and not os.path.exists(db_dir):
+            os.makedirs(db_dir)
+
+        return super()._connect()
+
+
+DATABASE = RSSDatabase(os.path.join(DB_DIR, "rss.db"), pragmas=RSSConfigManager().sqlite_pragmas)
 
 
 class BaseModel(Model):
@@ -23,6 +43,77 @@ class BaseModel(Model):
         database = DATABASE
 
 
+def filter_by_sent_status(search, sent_query, status="all"):
+    """根据发送状态过滤查询，sent_query 为与外层查询关联的发送记录子查询
+
+    过滤在同一条 SQL 中以 EXISTS / NOT EXISTS 完成，不再逐条查询发送记录
+    """
+    if status == "sent":
+        return search.where(fn.EXISTS(sent_query))
+    if status == "unsent":
+        return search.where(~fn.EXISTS(sent_query))
+
+    return search
+
+
+def iter_pages(query, date_field, batch_size=500, row_type="model"):
+    """按 (时间, id) 升序以键集分页的方式遍历查询结果
+
+    每一页都从上一页最后一条记录之后开始，配合 (过滤字段, 时间) 的联合索引只需扫描索引上的一段范围，
+    不会像 OFFSET 那样随页数增加越来越慢，内存中也最多只保留一页数据
+
+    Parameters
+    ----------
+    query: ModelSelect
+        选择了模型全部字段的查询，关联表的字段只能排在模型字段之后，不需要设置排序
+    date_field: Field
+        用于排序的时间字段
+    batch_size: int
+        每页的记录数量
+    row_type: str
+        返回结果的类型，可选 'model', 'tuples', 'dicts'，后两者不创建模型实例，开销更小
+    """
+    model = query.model
+    if row_type == "tuples":
+        # 字段的 == 会生成查询表达式，不能直接用 list.index 查找字段位置
+        names = [field.name for field in model._meta.sorted_fields]
+        get_key = itemgetter(
+            names.index(date_field.name), names.index(model._meta.primary_key.name)
+        )
+    elif row_type == "dicts":
+        get_key = itemgetter(date_field.name, model._meta.primary_key.name)
+    else:
+        get_key = attrgetter(date_field.name, model._meta.primary_key.name)
+
+    last = None
+    while True:
+        page = query
+        if last is not None:
+            last_date, last_id = last
+            # 前一个条件使查询从索引中的相应位置开始，后一个条件排除时间相同且已返回的记录
+            page = page.where(
+                date_field >= last_date,
+                (date_field > last_date) | (model._meta.primary_key > last_id),
+            )
+
+        page = page.order_by(date_field, model._meta.primary_key).limit(batch_size)
+        if row_type == "tuples":
+            page = page.tuples()
+        elif row_type == "dicts":
+            page = page.dicts()
+
+        rows = list(page)
+        yield from rows
+        if len(rows) < batch_size:
+            return
+
+        last = get_key(rows[-1])
+
+
+# 微信公众号文章统一发送到 Huginn，在发送队列中以此作为发送目标
+HUGINN_DEST = "huginn"
+
+
 class WechatArticle(BaseModel):
     """存储微信公众号文章的基本信息"""
 
@@ -30,22 +121,107 @@ class WechatArticle(BaseModel):
     title = CharField(index=True)
     description = CharField()
     url = CharField(unique=True, index=True)
-    date = DateTimeField()
+    date = DateTimeField(index=True)
+
+    class Meta:
+        indexes = ((("name", "date"), False),)
 
     @classmethod
-    def search_by_name(cls, name=None, limit=None):
+    def query_by_name(cls, name=None, status="all", skip_deferred=False):
+        """按公众号名称和发送状态过滤文章的查询，不设置排序，参数含义同 search_by_name"""
         search = cls.select()
         if name:
             search = search.where(cls.name == name)
 
+        sent_query = WechatArticleSentHistory.select(WechatArticleSentHistory.id).where(
+            WechatArticleSentHistory.url == cls.url
+        )
+        search = filter_by_sent_status(search, sent_query, status)
+        if skip_deferred:
+            search = search.where(~fn.EXISTS(Outbox.deferred(cls.url, HUGINN_DEST)))
+
+        return search
+
+    @classmethod
+    def search_by_name(cls, name=None, limit=None, status="all", offset=None, skip_deferred=False):
+        """按公众号名称查找文章
+
+        Parameters
+        ----------
+        name: str
+            公众号名称，不设置时查找所有文章
+        limit: int
+            只取最近的 limit 篇文章，结果按时间升序排列
+        status: str
+            发送状态，可选 'sent', 'unsent', 'all'
+        offset: int
+            设置 limit 时跳过最近的 offset 篇文章，用于分页
+        skip_deferred: bool
+            是否跳过发送队列中未到重试时间或已进入死信状态的文章
+        """
+        search = cls.query_by_name(name, status, skip_deferred)
         if limit:
-            search = search.order_by(cls.date.desc()).limit(limit)
+            search = search.order_by(cls.date.desc()).limit(limit).offset(offset)
             items = sorted(search, key=lambda item: item.date)
             return items
 
         search = search.order_by(cls.date)
         return search
 
+    @classmethod
+    def iter_by_name(
+        cls, name=None, status="all", skip_deferred=False, batch_size=500, row_type="model"
+    ):
+        """按时间升序分页遍历文章，适合处理大量文章，参数含义同 search_by_name 和 iter_pages"""
+        search = cls.query_by_name(name, status, skip_deferred)
+        return iter_pages(search, cls.date, batch_size, row_type)
+
+    @classmethod
+    def bulk_ingest(cls, items, batch_size=1000):
+        """分批写入文章及其发送记录，每批在一个事务中完成，已存在的文章（以 url 判断）会被忽略
+
+        items 可以是生成器，每次只读取一批数据，适合导入大量文章
+
+        Parameters
+        ----------
+        items: iterable of dict
+            文章数据，需包含 name、title、description、url、date 字段，
+            sent 字段为 True 时同时写入发送记录
+        batch_size: int
+            每批写入的最大文章数量
+
+        Return
+        ------
+        batches: generator
+            每写入一批返回一个 (处理的文章数量, 新写入的文章列表, 新写入的发送记录数量)
+        """
+        fields = ("name", "title", "description", "url", "date")
+        for batch in chunked(items, batch_size):
+            rows, sent_urls = {}, set()
+            for item in batch:
+                rows.setdefault(item["url"], {field: item[field] for field in fields})
+                if item.get("sent"):
+                    sent_urls.add(item["url"])
+
+            # IMMEDIATE 事务开始时即获取写锁，检查已存在的文章到写入之间不会有其他连接插入同样的
+            # 文章，返回的新文章与实际写入的一致
+            sent = 0
+            with cls._meta.database.atomic("IMMEDIATE"):
+                # 单条语句的参数数量需低于 SQLite 的上限（旧版本为 999）
+                existed = set()
+                for urls in chunked(list(rows), 500):
+                    query = cls.select(cls.url).where(cls.url.in_(urls)).tuples()
+                    existed.update(url for (url,) in query)
+
+                new_rows = [row for url, row in rows.items() if url not in existed]
+                for rows_chunk in chunked(new_rows, 100):
+                    cls.insert_many(rows_chunk).on_conflict_ignore().execute()
+                for urls in chunked(sent_urls, 500):
+                    query = WechatArticleSentHistory.insert_many([{"url": url} for url in urls])
+                    sent += query.on_conflict_ignore().as_rowcount().execute()
+
+            yield len(batch), new_rows, sent
+
     def to_dict(self):
         return {
             "name": self.name,
@@ -60,13 +236,18 @@ class WechatArticleSentHistory(BaseModel):
     """记录微信公众号文章的发送历史"""
 
     id = AutoField()
-    url = CharField(index=True)
+    url = CharField(unique=True)
     date = DateTimeField(default=datetime.datetime.now)
 
     @classmethod
     def is_sent(cls, url):
         return bool(cls.select().where(cls.url == url))
 
+    @classmethod
+    def mark_sent(cls, url):
+        """记录发送成功，重复记录会被忽略，返回新写入的记录数"""
+        return cls.insert(url=url).on_conflict_ignore().as_rowcount().execute()
+
 
 class Feed(BaseModel):
     """记录通用的 RSS 订阅源数据"""
@@ -77,6 +258,19 @@ class Feed(BaseModel):
     link = CharField(index=True)
     feed_link = CharField(index=True, unique=True)
     version = CharField(index=True)
+    etag = CharField(null=True)
+    last_modified = CharField(null=True)
+    last_fetched = DateTimeField(null=True)
+
+    def get_validators(self):
+        """获取用于条件请求的 HTTP 头"""
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+
+        return headers
 
 
 class Article(BaseModel):
@@ -86,34 +280,275 @@ class Article(BaseModel):
     title = CharField(index=True)
     summary = TextField()
     link = CharField(index=True, unique=True)
-    publish_date = DateTimeField(default=datetime.datetime.now)
+    publish_date = DateTimeField(default=datetime.datetime.now, index=True)
+
+    class Meta:
+        indexes = ((("feed", "publish_date"), False),)
 
     @classmethod
-    def search_by_feed(cls, feed_name, limit=None):
-        feed = Feed.get_or_none(Feed.name == feed_name)
-        if feed:
-            search = cls.select().where(cls.feed == feed)
-        else:
-            search = cls.select()
+    def search_by_feed(
+        cls, feed_name, limit=None, status="all", dest=None, offset=None, skip_deferred=False
+    ):
+        """按订阅源名称查找条目
 
+        Parameters
+        ----------
+        feed_name: str
+            订阅源名称，找不到对应订阅源时查找所有条目
+        limit: int
+            只取最近的 limit 个条目，结果按发布时间升序排列
+        status: str
+            发送状态，可选 'sent', 'unsent', 'all'
+        dest: str
+            发送目标，不设置时发送到任意目标都视为已发送
+        offset: int
+            设置 limit 时跳过最近的 offset 个条目，用于分页
+        skip_deferred: bool
+            是否跳过发送队列中未到重试时间或已进入死信状态的条目，需同时设置 dest
+        """
+        search = cls.query_by_feed(feed_name, status, dest, skip_deferred)
         if limit:
-            search = search.order_by(cls.publish_date.desc()).limit(limit)
+            search = search.order_by(cls.publish_date.desc()).limit(limit).offset(offset)
             items = sorted(search, key=lambda item: item.publish_date)
             return items
 
         return search
 
+    @classmethod
+    def query_by_feed(cls, feed_name, status="all", dest=None, skip_deferred=False):
+        """按订阅源和发送状态过滤条目的查询，不设置排序，参数含义同 search_by_feed
+
+        查询中关联了订阅源，访问 `article.feed` 时不会再为每个条目单独查询一次
+        """
+        search = cls.select(cls, Feed).join(Feed)
+        feed = Feed.get_or_none(Feed.name == feed_name)
+        if feed:
+            search = search.where(cls.feed == feed)
+
+        sent_query = SentHistory.select(SentHistory.id).where(SentHistory.url == cls.link)
+        if dest:
+            sent_query = sent_query.where(SentHistory.dest == dest)
+
+        search = filter_by_sent_status(search, sent_query, status)
+        if skip_deferred and dest:
+            search = search.where(~fn.EXISTS(Outbox.deferred(cls.link, dest)))
+
+        return search
+
+    @classmethod
+    def iter_by_feed(
+        cls,
+        feed_name,
+        status="all",
+        dest=None,
+        skip_deferred=False,
+        batch_size=500,
+        row_type="model",
+    ):
+        """按发布时间升序分页遍历条目，适合处理大量条目，参数含义同 search_by_feed 和 iter_pages
+
+        返回元组或字典时，订阅源名称以 `feed_name` 附加在条目字段之后
+        """
+        search = cls.query_by_feed(feed_name, status, dest, skip_deferred)
+        if row_type != "model":
+            # 订阅源与条目有同名字段，字典中会互相覆盖，因此只取订阅源名称
+            search = search.select(*cls._meta.sorted_fields, Feed.name.alias("feed_name"))
+
+        return iter_pages(search, cls.publish_date, batch_size, row_type)
+
+    @classmethod
+    def bulk_ingest(cls, feed, entries, batch_size=100):
+        """批量写入某个订阅源的条目，已存在的条目（以 link 判断）会被忽略
+
+        Parameters
+        ----------
+        feed: Feed
+            条目所属的订阅源
+        entries: list of dict
+            条目数据，需包含 title、link、summary、publish_date 字段
+        batch_size: int
+            单条 INSERT 语句写入的最大行数
+
+        Return
+        ------
+        created: int
+            新写入的条目数量
+        """
+        rows = {}
+        for entry in entries:
+            rows.setdefault(entry["link"], dict(entry, feed=feed))
+
+        existed = set()
+        for links in chunked(list(rows), 500):
+            query = cls.select(cls.link).where(cls.link.in_(links)).tuples()
+            existed.update(link for (link,) in query)
+
+        new_rows = [row for link, row in rows.items() if link not in existed]
+        created = 0
+        with cls._meta.database.atomic():
+            for batch in chunked(new_rows, batch_size):
+                created += cls.insert_many(batch).on_conflict_ignore().as_rowcount().execute()
+
+        return created
+
 
 class SentHistory(BaseModel):
     """记录文章发送记录"""
 
-    url = CharField(index=True)
+    url = CharField()
     date = DateTimeField(default=datetime.datetime.now)
     dest = CharField(index=True)
 
+    class Meta:
+        indexes = ((("url", "dest"), True),)
+
     @classmethod
     def is_sent(cls, url, dest=None):
         if not dest:
             return bool(cls.select().where(cls.url == url))
 
         return bool(cls.select().where(cls.url == url).where(cls.dest == dest))
+
+    @classmethod
+    def mark_sent(cls, url, dest):
+        """记录发送成功，重复记录会被忽略，返回新写入的记录数"""
+        return cls.insert(url=url, dest=dest).on_conflict_ignore().as_rowcount().execute()
+
+
+class Outbox(BaseModel):
+    """记录发送失败的文章，按指数退避重试，多次失败后进入死信状态"""
+
+    PENDING = "pending"
+    DEAD = "dead"
+
+    BASE_DELAY = 60
+    MAX_DELAY = 6 * 3600
+    MAX_ATTEMPTS = 8
+
+    url = CharField()
+    dest = CharField(index=True)
+    status = CharField(default=PENDING, index=True)
+    attempts = IntegerField(default=0)
+    next_attempt = DateTimeField(default=datetime.datetime.now)
+    last_error = TextField(null=True)
+    created = DateTimeField(default=datetime.datetime.now)
+
+    class Meta:
+        indexes = ((("url", "dest"), True),)
+
+    @classmethod
+    def get_delay(cls, attempts):
+        """第 attempts 次失败后距下次重试的秒数，带随机抖动避免重试集中在同一时刻"""
+        delay = min(cls.MAX_DELAY, cls.BASE_DELAY * 2 ** (attempts - 1))
+        return random.uniform(delay / 2, delay)
+
+    @classmethod
+    def record_failure(cls, url, dest, error):
+        now = datetime.datetime.now()
+        item, _ = cls.get_or_create(url=url, dest=dest)
+        item.attempts += 1
+        item.last_error = str(error)
+        if item.attempts >= cls.MAX_ATTEMPTS:
+            item.status = cls.DEAD
+        else:
+            item.next_attempt = now + datetime.timedelta(seconds=cls.get_delay(item.attempts))
+
+        item.save()
+        return item
+
+    @classmethod
+    def record_success(cls, url, dest):
+        return cls.delete().where(cls.url == url, cls.dest == dest).execute()
+
+    @classmethod
+    def deferred(cls, url_field, dest):
+        """与外层查询关联的子查询，匹配尚未到重试时间或已进入死信状态的记录"""
+        return cls.select(cls.id).where(
+            cls.url == url_field,
+            cls.dest == dest,
+            (cls.status == cls.DEAD) | (cls.next_attempt > datetime.datetime.now()),
+        )
+
+    @classmethod
+    def replay(cls, dest=None, ids=None):
+        """将死信重新放回队列，下次发送时立即重试，返回重新入队的数量"""
+        query = cls.update(status=cls.PENDING, attempts=0, next_attempt=datetime.datetime.now())
+        query = query.where(cls.status == cls.DEAD)
+        if dest:
+            query = query.where(cls.dest == dest)
+        if ids:
+            query = query.where(cls.id.in_(ids))
+
+        return query.execute()
+
+
+# trigram 分词需要 SQLite 3.34 及以上版本，更早的版本只能按空格和标点分词
+SEARCH_TOKENIZER = "trigram" if sqlite3.sqlite_version_info >= (3, 34, 0) else "unicode61"
+
+
+class SearchIndex(FTS5Model):
+    """RSS 条目和微信公众号文章的全文索引，由数据库触发器与原表保持同步
+
+    RSS 条目的 rowid 为 `article.id * 2`，微信公众号文章为 `wechatarticle.id * 2 + 1`；
+    使用 trigram 分词时可以匹配中文等不以空格分词的文本，但每个关键词至少需要 3 个字符
+    """
+
+    RSS = "rss"
+    WECHAT = "wechat"
+    MIN_TERM_LENGTH = 3 if SEARCH_TOKENIZER == "trigram" else 1
+
+    rowid = RowIDField()
+    title = SearchField()
+    content = SearchField()
+    kind = SearchField(unindexed=True)
+    source = SearchField(unindexed=True)
+    url = SearchField(unindexed=True)
+    date = SearchField(unindexed=True)
+
+    class Meta:
+        database = DATABASE
+        options = {"tokenize": SEARCH_TOKENIZER}
+
+    @classmethod
+    def search(cls, keywords, kind=None, source=None, start=None, end=None, limit=20):
+        """按关键词查找文章，结果按相关度排序，只有短关键词时按时间倒序排列
+
+        Parameters
+        ----------
+        keywords: str
+            以空格分隔的关键词，文章需包含所有关键词，短于 MIN_TERM_LENGTH 的关键词无法使用索引
+        kind: str
+            文章类型，可选 'rss', 'wechat'，不设置时查找所有文章
+        source: str
+            订阅源或公众号名称
+        start: datetime.date
+            只查找该时间及之后的文章
+        end: datetime.date
+            只查找该时间之前的文章
+        limit: int
+            最多返回的文章数量
+        """
+        terms = keywords.split()
+        phrases = [term for term in terms if len(term) >= cls.MIN_TERM_LENGTH]
+        search = cls.select(cls, SQL("rank").alias("score"))
+        if phrases:
+            # 关键词作为短语匹配，避免其中的符号被当作 FTS5 查询语法
+            query = " ".join('"{}"'.format(phrase.replace('"', '""')) for phrase in phrases)
+            search = search.where(cls.match(query)).order_by(SQL("rank"))
+        else:
+            search = search.order_by(cls.date.desc())
+
+        for term in terms:
+            if len(term) < cls.MIN_TERM_LENGTH:
+                search = search.where(cls.title.contains(term) | cls.content.contains(term))
+
+        if kind:
+            search = search.where(cls.kind == kind)
+        if source:
+            search = search.where(cls.source == source)
+        if start:
+            search = search.where(cls.date >= str(start))
+        if end:
+            search = search.where(cls.date < str(end))
+
+        return search.limit(limit)
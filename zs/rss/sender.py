@@ -3,6 +3,7 @@ from abc import ABC, abstractmethod
 
 import requests
 from lxml import html
+from requests.adapters import HTTPAdapter
 
 SENDERS = {}
 
@@ -22,10 +23,43 @@ def get_sender_cls(name):
     return SENDERS.get(name)
 
 
+def create_session(pool_size=10, proxy=None):
+    """创建复用连接的 HTTP 会话
+
+    Parameters
+    ----------
+    pool_size: int
+        每个域名保持的最大连接数量
+    proxy: dict
+        requests 格式的代理设置，如 {"https": "socks5://127.0.0.1:1080"}
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    if proxy:
+        session.proxies.update(proxy)
+
+    return session
+
+
 class Sender(ABC):
-    def __init__(self, dest_url, content=None, **kwargs):
+    def __init__(
+        self, dest_url, content=None, pool_size=10, timeout=30, proxy=None, session=None, **kwargs
+    ):
         self.dest_url = dest_url
         self.content = content or ["title", "images"]
+        self.timeout = timeout
+        self.session = session or create_session(pool_size, proxy)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
 
     @abstractmethod
     def prepare_data(self, article): ...
@@ -33,8 +67,11 @@ class Sender(ABC):
     def send(self, article):
         data = self.prepare_data(article)
         if data:
-            response = requests.post(
-                self.dest_url, json=data, headers={"Content-Type": "application/json"}
+            response = self.session.post(
+                self.dest_url,
+                json=data,
+                headers={"Content-Type": "application/json"},
+                timeout=self.timeout,
             )
             return response
 
@@ -1,15 +1,26 @@
+import asyncio
 import json
 import logging
 import os
 import re
+import time
+from collections import OrderedDict
 from enum import Enum
 from urllib.parse import parse_qsl, urlencode, urlparse
 
 import socks
 from telethon import TelegramClient as TelethonClient
 from telethon import sync  # noqa
+from telethon import utils as tg_utils
 from telethon.sessions import StringSession
-from telethon.tl.types import MessageEntityTextUrl, Photo
+from telethon.tl.types import (
+    InputPeerChannel,
+    InputPeerChat,
+    InputPeerSelf,
+    InputPeerUser,
+    MessageEntityTextUrl,
+    Photo,
+)
 
 from .consts import CONFIG_DIR, DATA_DIR
 
@@ -22,6 +33,72 @@ WX_CHANNEL_PREFIX_PATTERN = re.compile(r"(?:^微信)|" r"(?:^tele_wechat_bot$)")
 WX_IMAGE_AUTHOR_PAT = re.compile(r"^(?P<name>.+):\nsent a (?:picture|sticker)\.$")
 WX_GENERAL_AUTHOR_PAT = re.compile(r"^(?P<name>.+):[\n ]+")
 
+# 包含这些内容的消息会被忽略，可以在配置文件中用 `ignored_patterns` 覆盖
+DEFAULT_IGNORED_MSG_PATTERNS = [
+    r"WeChat Slave",
+    r"tele_wechat_bot",
+    r"^/",
+    r"System",
+    r"^Cancelled",
+]
+
+
+REGEX_SPECIAL_CHARS = set(".^$*+?{}[]\\|()")
+
+
+class IgnoreRules:
+    """编译后的消息忽略规则，每条消息只需检查一次，命中任意一条规则即停止
+
+    纯文本规则用字符串查找完成，``^`` 开头的纯文本规则用前缀比较完成，都比正则搜索快得多；
+    其余规则合并为一个正则，只搜索一遍。包含分组的规则合并后分组编号会改变，``\\1`` 这样的
+    反向引用会指向其他分组，因此单独编译；规则无法合并时（如使用了 ``(?i)`` 这样的全局标记）
+    也分别编译，逐条搜索
+    """
+
+    def __init__(self, patterns):
+        prefixes, keywords, regexes = [], [], []
+        for pattern in patterns:
+            if pattern.startswith("^") and not REGEX_SPECIAL_CHARS & set(pattern[1:]):
+                prefixes.append(pattern[1:])
+            elif not REGEX_SPECIAL_CHARS & set(pattern):
+                keywords.append(pattern)
+            else:
+                regexes.append(pattern)
+
+        self.prefixes = tuple(prefixes)
+        self.keywords = tuple(keywords)
+        self.patterns = self.compile_regexes(regexes)
+
+    @staticmethod
+    def compile_regexes(regexes):
+        compiled = [re.compile(pat) for pat in regexes]
+        separate = [pattern for pattern in compiled if pattern.groups]
+        combinable = [pattern for pattern in compiled if not pattern.groups]
+        if len(combinable) > 1:
+            try:
+                combined = "|".join(f"(?:{pattern.pattern})" for pattern in combinable)
+                combinable = [re.compile(combined)]
+            except re.error:
+                LOGGER.debug("cannot combine ignored patterns, compile them separately")
+
+        return tuple(separate + combinable)
+
+    def search(self, text):
+        """判断文本是否命中任意一条规则"""
+        return (
+            text.startswith(self.prefixes)
+            or any(keyword in text for keyword in self.keywords)
+            or any(pattern.search(text) is not None for pattern in self.patterns)
+        )
+
+
+def compile_ignored_patterns(patterns):
+    """将多条忽略规则编译为 IgnoreRules，没有规则时返回 None"""
+    if not patterns:
+        return None
+
+    return IgnoreRules(patterns)
+
 
 class TelegramConfigManager:
     DEFAULT_DOWNLOAD_PATH = os.path.join(DATA_DIR, "telegram")
@@ -81,6 +158,318 @@ class TelegramConfigManager:
     def user(self):
         return self.data.get("user")
 
+    @property
+    def ignored_patterns(self):
+        return self.data.get("ignored_patterns", DEFAULT_IGNORED_MSG_PATTERNS)
+
+    @property
+    def dialog_cache_ttl(self):
+        return self.data.get("dialog_cache_ttl", DialogCache.DEFAULT_TTL)
+
+    @property
+    def user_cache_size(self):
+        return self.data.get("user_cache_size", UserCache.DEFAULT_MAXSIZE)
+
+    @property
+    def persist_user_cache(self):
+        return self.data.get("persist_user_cache", False)
+
+    @property
+    def download_workers(self):
+        return self.data.get("download_workers", MediaDownloader.DEFAULT_WORKERS)
+
+
+class DialogCache:
+    """聊天名称到 peer 的索引，保存在本地文件中，超过 ttl 秒后整体失效
+
+    StringSession 不会保存实体信息，每次按名称查找聊天都需要遍历全部对话，
+    缓存 peer 的 id 和 access_hash 后可以直接构造 InputPeer 发起请求
+    """
+
+    DEFAULT_CACHE_FILE = os.path.join(DATA_DIR, "telegram_dialogs.json")
+    DEFAULT_TTL = 86400
+
+    def __init__(self, cache_file=DEFAULT_CACHE_FILE, ttl=DEFAULT_TTL):
+        self.cache_file = cache_file
+        self.ttl = ttl
+        self.updated = 0
+        self.dialogs = {}
+        if os.path.exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    data = json.load(f)
+                self.updated = data.get("updated", 0)
+                self.dialogs = data.get("dialogs", {})
+            except (ValueError, OSError):
+                LOGGER.warning("ignore broken dialog cache file: %s", cache_file)
+
+    @property
+    def expired(self):
+        return time.time() - self.updated > self.ttl
+
+    @staticmethod
+    def dump_peer(entity):
+        try:
+            peer = tg_utils.get_input_peer(entity)
+        except TypeError:
+            return None
+
+        if isinstance(peer, InputPeerChannel):
+            return {"type": "channel", "id": peer.channel_id, "access_hash": peer.access_hash}
+        if isinstance(peer, InputPeerUser):
+            return {"type": "user", "id": peer.user_id, "access_hash": peer.access_hash}
+        if isinstance(peer, InputPeerChat):
+            return {"type": "chat", "id": peer.chat_id}
+        if isinstance(peer, InputPeerSelf):
+            return {"type": "self"}
+
+        return None
+
+    @staticmethod
+    def load_peer(data):
+        if data["type"] == "channel":
+            return InputPeerChannel(data["id"], data["access_hash"])
+        if data["type"] == "user":
+            return InputPeerUser(data["id"], data["access_hash"])
+        if data["type"] == "chat":
+            return InputPeerChat(data["id"])
+        if data["type"] == "self":
+            return InputPeerSelf()
+
+        return None
+
+    def get(self, name):
+        """返回名称对应的 InputPeer，不存在或缓存已失效时返回 None"""
+        if self.expired or name not in self.dialogs:
+            return None
+
+        return self.load_peer(self.dialogs[name])
+
+    def update(self, dialogs):
+        """用完整的对话列表重建索引并保存，dialogs 为 (name, entity) 列表"""
+        self.dialogs = {}
+        for name, entity in dialogs:
+            peer = self.dump_peer(entity)
+            if name and peer and name not in self.dialogs:
+                self.dialogs[name] = peer
+
+        self.updated = time.time()
+        self.save()
+
+    def save(self):
+        cache_dir = os.path.dirname(self.cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        with open(self.cache_file, "w") as f:
+            json.dump(
+                {"updated": self.updated, "dialogs": self.dialogs}, f, ensure_ascii=False, indent=4
+            )
+
+
+class UserCache:
+    """消息发送者 id 到用户名的 LRU 缓存，避免为每条消息都请求一次 get_entity
+
+    设置 cache_file 时缓存会在多次运行间保留
+    """
+
+    DEFAULT_CACHE_FILE = os.path.join(DATA_DIR, "telegram_users.json")
+    DEFAULT_MAXSIZE = 10000
+
+    def __init__(self, maxsize=DEFAULT_MAXSIZE, cache_file=None):
+        self.maxsize = maxsize
+        self.cache_file = cache_file
+        self.users = OrderedDict()
+        self.hits, self.misses = 0, 0
+        if cache_file and os.path.exists(cache_file):
+            try:
+                with open(cache_file) as f:
+                    for peer_id, username in json.load(f):
+                        self.put(peer_id, username)
+            except (ValueError, OSError):
+                LOGGER.warning("ignore broken user cache file: %s", cache_file)
+
+    def get(self, peer_id):
+        """返回 (是否命中, 用户名)，用户名本身可能为 None"""
+        if peer_id not in self.users:
+            self.misses += 1
+            return False, None
+
+        self.hits += 1
+        self.users.move_to_end(peer_id)
+        return True, self.users[peer_id]
+
+    def put(self, peer_id, username):
+        self.users[peer_id] = username
+        self.users.move_to_end(peer_id)
+        while len(self.users) > self.maxsize:
+            self.users.popitem(last=False)
+
+    async def resolve(self, client, peer):
+        peer_id = tg_utils.get_peer_id(peer)
+        hit, username = self.get(peer_id)
+        if not hit:
+            username = (await client.get_entity(peer)).username
+            self.put(peer_id, username)
+
+        return username
+
+    def save(self):
+        if not self.cache_file:
+            return
+
+        cache_dir = os.path.dirname(self.cache_file)
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+        with open(self.cache_file, "w") as f:
+            json.dump(list(self.users.items()), f, ensure_ascii=False)
+
+
+async def download_media(origin, path):
+    """下载消息中的媒体文件，先写入临时文件再重命名，中断的下载不会被当作已下载
+
+    Return
+    ------
+    size: int
+        下载得到的文件大小
+    """
+    download_path = os.path.dirname(path)
+    if download_path and not os.path.exists(download_path):
+        os.makedirs(download_path)
+
+    tmp_path = await origin.download_media(path + ".part")
+    if not tmp_path:
+        return 0
+
+    os.replace(tmp_path, path)
+    LOGGER.info("download image file: %s", path)
+    return os.path.getsize(path)
+
+
+class MediaDownloader:
+    """在后台用固定数量的协程并发下载图片，同一目标路径只会下载一次"""
+
+    DEFAULT_WORKERS = 4
+    PROGRESS_INTERVAL = 20
+
+    def __init__(self, workers=DEFAULT_WORKERS):
+        self.workers = workers
+        self.queue = None
+        self.tasks = []
+        self.paths = set()
+        self.downloaded, self.failed, self.size = 0, 0, 0
+        self.start_time = None
+
+    def start(self):
+        self.queue = asyncio.Queue(maxsize=self.workers * 4)
+        self.tasks = [asyncio.ensure_future(self._work()) for _ in range(self.workers)]
+        self.start_time = time.time()
+
+    async def submit(self, message):
+        """将消息中的图片加入下载队列，已存在或已在队列中的文件会被忽略"""
+        path = message.photo_path
+        if not path or path in self.paths or os.path.exists(path):
+            return
+
+        if self.queue is None:
+            self.start()
+
+        self.paths.add(path)
+        await self.queue.put((message.origin, path))
+
+    async def _work(self):
+        while True:
+            origin, path = await self.queue.get()
+            try:
+                size = await download_media(origin, path)
+                self.size += size
+                self.downloaded += 1
+            except Exception:  # noqa
+                self.failed += 1
+                LOGGER.exception("failed to download image file: %s", path)
+            finally:
+                self.queue.task_done()
+
+            if self.downloaded and self.downloaded % self.PROGRESS_INTERVAL == 0:
+                self.report()
+
+    def report(self):
+        elapsed = max(time.time() - self.start_time, 1e-6)
+        LOGGER.info(
+            "downloaded %d images (%d failed), %.1f images/s, %.1f KB/s",
+            self.downloaded,
+            self.failed,
+            self.downloaded / elapsed,
+            self.size / 1024 / elapsed,
+        )
+
+    async def join(self):
+        """等待队列中的图片全部下载完成"""
+        if self.queue is None:
+            return
+
+        await self.queue.join()
+        for task in self.tasks:
+            task.cancel()
+
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.report()
+        self.queue, self.tasks = None, []
+
+
+class CheckpointStore:
+    """记录每个聊天已处理到的最新消息，用于增量获取消息
+
+    检查点按 (聊天名称, 消息类型) 区分，获取不同类型消息的任务互不影响；获取过程中的更新
+    只保存在内存中，调用方在消息持久化之后调用 `commit` 才会写入文件
+    """
+
+    DEFAULT_CHECKPOINT_FILE = os.path.join(DATA_DIR, "telegram_checkpoints.json")
+
+    def __init__(self, checkpoint_file=DEFAULT_CHECKPOINT_FILE):
+        self.checkpoint_file = checkpoint_file
+        self.checkpoints = {}
+        self.pending = {}
+        if os.path.exists(checkpoint_file):
+            with open(checkpoint_file) as f:
+                self.checkpoints = json.load(f)
+
+    @staticmethod
+    def make_key(name, msg_type=None):
+        """不限消息类型时直接以聊天名称为键，与旧版本的检查点文件兼容"""
+        return f"{name}#{msg_type}" if msg_type else name
+
+    def get(self, name, msg_type=None):
+        """返回已提交的 {"id": 消息 id, "date": 消息时间}，没有检查点时返回 None"""
+        return self.checkpoints.get(self.make_key(name, msg_type))
+
+    def update(self, name, msg_type, message_id, date):
+        """记录待提交的检查点，检查点只会前进，传入更早的消息时不做修改"""
+        key = self.make_key(name, msg_type)
+        checkpoint = self.pending.get(key) or self.checkpoints.get(key)
+        if checkpoint and checkpoint["id"] >= message_id:
+            return
+
+        self.pending[key] = {"id": message_id, "date": str(date)}
+
+    def commit(self):
+        """将待提交的检查点写入文件，应在已获取的消息都持久化之后调用"""
+        if not self.pending:
+            return
+
+        self.checkpoints.update(self.pending)
+        self.pending = {}
+        self.save()
+
+    def save(self):
+        checkpoint_dir = os.path.dirname(self.checkpoint_file)
+        if not os.path.exists(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+
+        with open(self.checkpoint_file, "w") as f:
+            json.dump(self.checkpoints, f, ensure_ascii=False, indent=4)
+
 
 def get_proxy_from_uri(uri):
     if not uri:
@@ -125,6 +514,36 @@ class MessageType(Enum):
         raise ValueError("Invalid type name %s" % type_name)
 
 
+def match_wx_author(line, newline=False):
+    """查找一行微信消息开头形如 `用户名: ` 的发送者，结果与用 WX_GENERAL_AUTHOR_PAT 匹配相同
+
+    只用字符串查找定位发送者的结束位置，不会回溯扫描整行
+
+    Parameters
+    ----------
+    line: str
+        不含换行符的一行文本
+    newline: bool
+        该行之后是否还有换行符，为 True 时行末的 `:` 也视为发送者的结束位置
+
+    Return
+    ------
+    author: str
+        去掉首尾空白后的发送者，没有找到时为 None
+    start: int
+        发送者在行中的起始位置，没有找到时为 -1
+    """
+    if newline and len(line) > 1 and line.endswith(":"):
+        end = len(line) - 1
+    else:
+        end = line.rfind(": ", 1)
+        if end < 0:
+            return None, -1
+
+    name = line[:end]
+    return name.strip(), len(name) - len(name.lstrip())
+
+
 def clean_user_name(user_name):
     user_name = re.sub(r"\[[^\[\]]+\]$", "", user_name)
     user_name = user_name.replace(WX_ARTICLE_PREFIX, "").strip(": ")
@@ -133,6 +552,10 @@ def clean_user_name(user_name):
     return user_name
 
 
+# Message.parse 的 user 参数默认值，表示发送者尚未查询
+UNRESOLVED_USER = object()
+
+
 class Message:
     WX_MSG_TYPES = (MessageType.WX_TEXT, MessageType.WX_IMAGE, MessageType.WX_ARTICLE)
     IMG_MSG_TYPES = (MessageType.IMAGE, MessageType.WX_IMAGE, MessageType.MULTI)
@@ -210,40 +633,41 @@ class Message:
     def parse_wx_text_message(cls, message):
         # FIXME: 未考虑引用的情况
         user = "unknown"
-        if message.raw_text.endswith("You:"):
+        raw_text = message.raw_text
+        if raw_text.endswith("You:"):
             user = "You"
-            content = message.raw_text.replace("You:", "").strip()
-        elif message.raw_text.startswith("Error: Empty Sticker received"):
-            content = message.raw_text
-        elif message.raw_text.find("\n") >= 0:
-            lines = message.raw_text.split("\n")
-            possible_users = []
-            for line in lines:
-                matches = WX_GENERAL_AUTHOR_PAT.match(line)
-                if matches:
-                    possible_users.append(matches.groupdict()["name"].strip())
-                else:
-                    possible_users.append(None)
-
-            if len(set(possible_users)) == 1 and possible_users[0] is not None:
-                user = possible_users[0]
-                content = "\n".join(
-                    [line.replace(user, "", 1).strip().strip(":") for line in lines]
-                )
+            content = raw_text.replace("You:", "").strip()
+        elif raw_text.startswith("Error: Empty Sticker received"):
+            content = raw_text
+        elif raw_text.find("\n") >= 0:
+            lines = raw_text.split("\n")
+            author, _ = match_wx_author(lines[0])
+            contents = []
+            if author is not None:
+                # 每行的发送者都相同时才认为是同一个人的多行消息，遇到不同的发送者即停止
+                for line in lines:
+                    line_author, start = match_wx_author(line)
+                    if line_author != author:
+                        break
+                    contents.append(line[start + len(author) :].strip().strip(":"))
+
+            if len(contents) == len(lines):
+                user = author
+                content = "\n".join(contents)
             else:
-                matches = WX_GENERAL_AUTHOR_PAT.match(message.raw_text)
-                if matches:
-                    user = matches.groupdict()["name"].strip()
-                    content = message.raw_text.replace(user, "", 1).strip().strip(":")
+                author, start = match_wx_author(lines[0], newline=True)
+                if author is not None:
+                    user = author
+                    content = raw_text[start + len(author) :].strip().strip(":")
                 else:
-                    user, content = message.raw_text.split("\n", maxsplit=1)
+                    user, content = lines[0], raw_text[len(lines[0]) + 1 :]
         else:
-            matches = WX_GENERAL_AUTHOR_PAT.match(message.raw_text)
-            if matches:
-                user = matches.groupdict()["name"].strip()
-                content = message.raw_text.replace(user, "", 1).strip().strip(":")
+            author, start = match_wx_author(raw_text)
+            if author is not None:
+                user = author
+                content = raw_text[start + len(author) :].strip().strip(":")
             else:
-                content = message.raw_text
+                content = raw_text
 
         user = clean_user_name(user)
         user = user.replace(WX_ARTICLE_PREFIX, "").strip(": ")
@@ -312,7 +736,12 @@ class Message:
         raise NotImplementedError
 
     @classmethod
-    def parse(cls, message, msg_type=None, config=None, wx_msg_index=None):
+    def parse(cls, message, msg_type=None, config=None, wx_msg_index=None, user=UNRESOLVED_USER):
+        """解析 Telethon 消息
+
+        user 为调用方已查询到的发送者用户名（可能为 None），未传入时才会通过
+        `get_entity` 同步查询，异步客户端中必须传入
+        """
         msg_type = msg_type or cls.get_message_type(message) or MessageType.OTHER
         if msg_type in cls.WX_MSG_TYPES:
             return cls.parse_wx_message(message, msg_type, config, wx_msg_index)
@@ -340,10 +769,11 @@ class Message:
                     },
                 ]
 
-        if message.from_id:
-            user = message.client.get_entity(message.from_id).username
-        else:
+        if not message.from_id:
             user = chat_name
+        elif user is UNRESOLVED_USER:
+            user = message.client.get_entity(message.from_id).username
+
         return cls(
             message.id,
             msg_type,
@@ -354,6 +784,18 @@ class Message:
             message,
         )
 
+    @property
+    def photo_path(self):
+        """图片消息的本地保存路径，非图片消息返回 None"""
+        if self.type not in self.IMG_MSG_TYPES:
+            return None
+        if isinstance(self.content, str):
+            return self.content
+        if isinstance(self.content, list) and self.content[0]["type"] == MessageType.IMAGE:
+            return self.content[0]["content"]
+
+        return None
+
     def to_dict(self):
         data = {
             "id": self.id,
@@ -369,14 +811,8 @@ class Message:
         return data
 
 
-class TelegramClient:
-    IGNORED_MSG_PATTERNS = [
-        re.compile(r"WeChat Slave"),
-        re.compile(r"tele_wechat_bot"),
-        re.compile(r"^/"),
-        re.compile(r"System"),
-        re.compile(r"^Cancelled"),
-    ]
+class AsyncTelegramClient:
+    """基于 asyncio 的 Telegram 客户端，可以在同一个进程中并发获取多个聊天的消息"""
 
     def __init__(self, config_manager=None):
         config_manager = config_manager or TelegramConfigManager()
@@ -386,22 +822,39 @@ class TelegramClient:
             config_manager.api_hash = api_hash
             config_manager.save()
 
-        api_id, api_hash = config_manager.api_id, config_manager.api_hash
-        proxy = get_proxy_from_uri(config_manager.proxy)
-        if not config_manager.session:
-            session = StringSession()
-            with TelethonClient(session, api_id, api_hash, proxy=proxy) as client:
-                config_manager.session = client.session.save()
-                config_manager.save()
-
-        # sync 模式下这里要加一个 start()，去掉的话会触发 ConnectionError 异常
         self.client = TelethonClient(
             StringSession(config_manager.session),
             config_manager.api_id,
             config_manager.api_hash,
-            proxy=proxy,
-        ).start()
+            proxy=get_proxy_from_uri(config_manager.proxy),
+        )
         self.config_manager = config_manager
+        self.ignore_rules = compile_ignored_patterns(config_manager.ignored_patterns)
+        self.dialog_cache = DialogCache(ttl=config_manager.dialog_cache_ttl)
+        self.checkpoints = CheckpointStore()
+        self.download_workers = config_manager.download_workers
+        self.user_cache = UserCache(
+            maxsize=config_manager.user_cache_size,
+            cache_file=UserCache.DEFAULT_CACHE_FILE if config_manager.persist_user_cache else None,
+        )
+
+    async def start(self):
+        """连接并登录，首次登录后将 session 保存到配置文件中"""
+        await self.client.start()
+        if not self.config_manager.session:
+            self.config_manager.session = self.client.session.save()
+            self.config_manager.save()
+
+        return self
+
+    async def close(self):
+        await self.client.disconnect()
+
+    async def __aenter__(self):
+        return await self.start()
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
 
     @staticmethod
     def ask_base_info():
@@ -413,14 +866,220 @@ class TelegramClient:
         api_hash = input("App api_hash").strip()
         return api_id, api_hash
 
-    def get_dialog(self, name):
-        for dialog in self.client.get_dialogs():
-            if dialog.name == name:
-                return dialog
+    async def get_dialog(self, name):
+        """遍历所有对话查找名称为 name 的对话，同时重建对话索引缓存"""
+        result, dialogs = None, []
+        async for dialog in self.client.iter_dialogs():
+            dialogs.append((dialog.name, dialog.entity))
+            if result is None and dialog.name == name:
+                result = dialog
+
+        self.dialog_cache.update(dialogs)
+        return result
+
+    async def resolve_chat(self, name):
+        """按名称查找聊天，优先使用对话索引缓存，缓存未命中时重新遍历对话"""
+        peer = self.dialog_cache.get(name)
+        if peer is not None:
+            return peer
+
+        dialog = await self.get_dialog(name)
+        return dialog.entity if dialog else None
+
+    async def parse_message(self, message):
+        msg_type = Message.get_message_type(message)
+        user = UNRESOLVED_USER
+        if msg_type not in Message.WX_MSG_TYPES and message.from_id:
+            user = await self.user_cache.resolve(self.client, message.from_id)
+
+        return Message.parse(message, msg_type, config=self.config_manager, user=user)
+
+    def is_ignored(self, message):
+        return (
+            self.ignore_rules is not None
+            and isinstance(message.raw_text, str)
+            and self.ignore_rules.search(message.raw_text)
+        )
 
-        return None
+    async def iter_messages(
+        self,
+        name,
+        start=None,
+        end=None,
+        offset_id=None,
+        batch=100,
+        limit=None,
+        msg_type=None,
+        verbose=False,
+        incremental=False,
+    ):
+        """逐条获取某个频道或群组的聊天记录
 
-    def fetch_messages(
+        普通模式下按时间从新到旧返回 Message；增量模式下若该聊天已有检查点，
+        只获取检查点之后的新消息，并按时间从旧到新返回，参数同 `fetch_messages`
+
+        增量模式下检查点不会自动保存，调用方需在消息持久化之后调用 `commit_checkpoints`
+        """
+        entity = await self.resolve_chat(name)
+        if entity is None:
+            return
+
+        checkpoint = self.checkpoints.get(name, msg_type) if incremental else None
+        downloader = MediaDownloader(self.download_workers)
+        try:
+            if checkpoint:
+                messages = self._iter_since_checkpoint(
+                    entity, name, checkpoint, start, end, limit, msg_type, downloader, verbose
+                )
+            else:
+                messages = self._iter_history(
+                    entity,
+                    name,
+                    start,
+                    end,
+                    offset_id,
+                    batch,
+                    limit,
+                    msg_type,
+                    downloader,
+                    verbose,
+                    incremental,
+                )
+
+            async for msg in messages:
+                yield msg
+        finally:
+            await downloader.join()
+            if verbose:
+                LOGGER.info(
+                    "user cache: %d hits, %d misses", self.user_cache.hits, self.user_cache.misses
+                )
+            self.user_cache.save()
+
+    async def _accept(self, message, msg_type, downloader):
+        """解析消息并判断是否符合要求，符合时返回 Message，图片会加入下载队列"""
+        msg = await self.parse_message(message)
+        if not msg.content:
+            return None
+
+        if msg_type and msg.type != MessageType.from_str(msg_type):
+            return None
+
+        if msg.type in Message.IMG_MSG_TYPES:
+            await downloader.submit(msg)
+
+        return msg
+
+    async def _iter_since_checkpoint(
+        self, entity, name, checkpoint, start, end, limit, msg_type, downloader, verbose
+    ):
+        """从检查点开始按时间从旧到新获取新消息，每处理一条消息就记录待提交的检查点"""
+        valid_cnt, cnt = 0, 0
+        async for message in self.client.iter_messages(
+            entity, min_id=checkpoint["id"], reverse=True
+        ):
+            if end and message.date >= end:
+                break
+
+            cnt += 1
+            if verbose and cnt % 100 == 0:
+                LOGGER.info("processed %d messages and got %d valid messages", cnt, valid_cnt)
+
+            msg = None
+            if not self.is_ignored(message) and not (start and message.date < start):
+                msg = await self._accept(message, msg_type, downloader)
+
+            self.checkpoints.update(name, msg_type, message.id, message.date)
+            if msg:
+                valid_cnt += 1
+                yield msg
+
+            if limit and valid_cnt >= limit:
+                break
+
+    async def _iter_history(
+        self,
+        entity,
+        name,
+        start,
+        end,
+        offset_id,
+        batch,
+        limit,
+        msg_type,
+        downloader,
+        verbose,
+        incremental,
+    ):
+        """按时间从新到旧分批获取 [start, end) 时间范围内的消息
+
+        第一批以 offset_date=end（或调用方给出的 offset_id）为起点，由服务端跳过
+        晚于 end 的消息，之后每一批都以上一批最早的消息 id 为 offset_id 继续向前
+        翻页；遇到早于 start 的消息、取够 limit 条、某一批不满或 offset_id 不再
+        减小时停止，保证每次请求都有进展且一定会结束
+        """
+        valid_cnt, cnt = 0, 0
+        batch_size = batch if not limit else min(limit, batch)
+        offset_id = offset_id or 0
+        while True:
+            page = self.client.iter_messages(
+                entity,
+                limit=batch_size,
+                offset_id=offset_id,
+                offset_date=None if offset_id else end,
+            )
+            page_size, last_id, finished = 0, None, False
+            async for message in page:
+                page_size += 1
+                last_id = message.id
+                if start and message.date < start:
+                    finished = True
+                    break
+
+                cnt += 1
+                if verbose and cnt % 100 == 0:
+                    LOGGER.info("processed %d messages and got %d valid messages", cnt, valid_cnt)
+
+                if end and message.date >= end:
+                    continue
+
+                if incremental:
+                    self.checkpoints.update(name, msg_type, message.id, message.date)
+
+                if self.is_ignored(message):
+                    continue
+
+                msg = await self._accept(message, msg_type, downloader)
+                if msg:
+                    valid_cnt += 1
+                    yield msg
+
+                if limit and valid_cnt >= limit:
+                    finished = True
+                    break
+
+            if finished or page_size < batch_size:
+                break
+
+            if offset_id and last_id >= offset_id:
+                LOGGER.warning("paging made no progress at message %d, stop fetching", offset_id)
+                break
+
+            offset_id = last_id
+
+    async def iter_raw_messages(self, name, start=None, end=None, limit=None):
+        """按时间从新到旧返回 [start, end) 范围内的 Telethon 原始消息，不做解析和过滤"""
+        entity = await self.resolve_chat(name)
+        if entity is None:
+            return
+
+        async for message in self.client.iter_messages(entity, limit=limit, offset_date=end):
+            if start and message.date < start:
+                break
+
+            yield message
+
+    async def fetch_messages(
         self,
         name,
         start=None,
@@ -430,6 +1089,7 @@ class TelegramClient:
         limit=None,
         msg_type=None,
         verbose=False,
+        incremental=False,
     ):
         """获取某个频道或群组的聊天记录
 
@@ -442,7 +1102,7 @@ class TelegramClient:
         end: datetime
             消息的结束时间，晚于该时间的消息将会被忽略，默认不设置取所有消息
         offset_id: int
-            TODO
+            从该 id 的消息开始向前获取（不包含该消息），设置后 end 只在本地过滤
         batch: int
             获取消息时为减少网络开销，将会一批一批获取，该参数用于设置每个批次的
             最大消息数量，默认设置为 100
@@ -452,90 +1112,130 @@ class TelegramClient:
         msg_type: str
             消息类型，可选 'text', 'image' 两类，默认不设置获取所有类型
             的消息
+        incremental: bool
+            是否使用检查点增量获取，开启时若该聊天已有检查点，则只获取检查点之后
+            的新消息（此时 limit 限制的是最早的 limit 条新消息，剩余的留到下次获取）；
+            检查点按聊天名称和 msg_type 区分，消息持久化后需调用 `commit_checkpoints`
+            将检查点更新为已处理的最新消息
 
         Return
         ------
         results: list of Message
+            按时间从旧到新排列
         """
-        dialog = self.get_dialog(name)
-        if not dialog:
-            return []
+        results = [
+            msg
+            async for msg in self.iter_messages(
+                name,
+                start=start,
+                end=end,
+                offset_id=offset_id,
+                batch=batch,
+                limit=limit,
+                msg_type=msg_type,
+                verbose=verbose,
+                incremental=incremental,
+            )
+        ]
+        results.sort(key=lambda msg: msg.id)
+        return results
+
+    def commit_checkpoints(self):
+        """保存增量获取时记录的检查点，应在获取到的消息都持久化之后调用"""
+        self.checkpoints.commit()
+
+    async def fetch_many(self, names, **kwargs):
+        """并发获取多个聊天的消息，返回聊天名称到消息列表的字典，其他参数同 `fetch_messages`"""
+        results = await asyncio.gather(*[self.fetch_messages(name, **kwargs) for name in names])
+        return dict(zip(names, results))
+
+    async def download_photo(self, message):
+        photo = message.photo_path
+        if not photo or os.path.exists(photo):
+            return
 
-        results, cnt = [], 0
-        batch_size = batch if not limit else min(limit, batch)
-        last_offset_id = None
-        while True:
-            if offset_id:
-                message_packages = self.client.iter_messages(
-                    dialog.entity, limit=batch_size, offset_id=offset_id
-                )
-                last_offset_id = offset_id
-            else:
-                message_packages = self.client.iter_messages(
-                    dialog.entity,
-                    limit=batch_size,
-                )
+        await download_media(message.origin, photo)
 
-            msg_timestamp = None
-            for message in message_packages:
-                if cnt > 0 and verbose:
-                    LOGGER.info(
-                        "processed %d messages and got %d valid messages",
-                        cnt,
-                        len(results),
-                    )
 
-                cnt += 1
-                if isinstance(message.raw_text, str) and any(
-                    pat.findall(message.raw_text) for pat in self.IGNORED_MSG_PATTERNS
-                ):
-                    continue
+class TelegramClient:
+    """AsyncTelegramClient 的同步封装，供命令行使用"""
 
-                offset_id = message.id
-                msg = Message.parse(message, config=self.config_manager)
-                msg_timestamp = message.date
-                if start and msg.timestamp < start:
-                    break
+    def __init__(self, config_manager=None):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.async_client = AsyncTelegramClient(config_manager)
+        self.loop.run_until_complete(self.async_client.start())
+        self.client = self.async_client.client
+        self.config_manager = self.async_client.config_manager
 
-                if end and msg.timestamp >= end:
-                    continue
+    def _run(self, coro):
+        return self.loop.run_until_complete(coro)
 
-                if not msg.content:
-                    continue
+    def close(self):
+        self._run(self.async_client.close())
 
-                if not msg_type or msg.type == MessageType.from_str(msg_type):
-                    results.append(msg)
-                    if msg.type in Message.IMG_MSG_TYPES:
-                        self.download_photo(msg)
+    ask_base_info = AsyncTelegramClient.ask_base_info
 
-                if limit and len(results) >= limit:
-                    break
+    def get_dialog(self, name):
+        return self._run(self.async_client.get_dialog(name))
 
-            if start and msg_timestamp and msg_timestamp < start:
-                break
+    def resolve_chat(self, name):
+        return self._run(self.async_client.resolve_chat(name))
 
-            if limit and len(results) >= limit:
-                break
+    def fetch_messages(
+        self,
+        name,
+        start=None,
+        end=None,
+        offset_id=None,
+        batch=100,
+        limit=None,
+        msg_type=None,
+        verbose=False,
+        incremental=False,
+    ):
+        """获取某个频道或群组的聊天记录，参数见 `AsyncTelegramClient.fetch_messages`"""
+        return self._run(
+            self.async_client.fetch_messages(
+                name,
+                start=start,
+                end=end,
+                offset_id=offset_id,
+                batch=batch,
+                limit=limit,
+                msg_type=msg_type,
+                verbose=verbose,
+                incremental=incremental,
+            )
+        )
 
-            if offset_id == last_offset_id:
-                break
+    def fetch_many(self, names, **kwargs):
+        return self._run(self.async_client.fetch_many(names, **kwargs))
 
-        return results[::-1]
+    def iter_messages(self, name, **kwargs):
+        """逐条获取聊天记录的同步生成器，不会在内存中保存全部消息
 
-    def download_photo(self, message):
-        photo = None
-        if isinstance(message.content, str):
-            photo = message.content
-        elif isinstance(message.content, list):
-            if message.content[0]["type"] == MessageType.IMAGE:
-                photo = message.content[0]["content"]
+        参数见 `AsyncTelegramClient.iter_messages`
+        """
+        return self._iter(self.async_client.iter_messages(name, **kwargs))
 
-        if not photo or os.path.exists(photo):
-            return
+    def iter_raw_messages(self, name, start=None, end=None, limit=None):
+        """逐条获取 Telethon 原始消息，参数见 `AsyncTelegramClient.iter_raw_messages`"""
+        return self._iter(self.async_client.iter_raw_messages(name, start, end, limit))
 
-        download_path = os.path.dirname(photo)
-        if not os.path.exists(download_path):
-            os.makedirs(download_path)
+    def _iter(self, messages):
+        """在事件循环中逐个驱动异步生成器，转换为同步生成器"""
+        try:
+            while True:
+                try:
+                    yield self._run(messages.__anext__())
+                except StopAsyncIteration:
+                    break
+        finally:
+            self._run(messages.aclose())
+
+    def commit_checkpoints(self):
+        self.async_client.commit_checkpoints()
 
-        message.origin.download_media(photo)
-        LOGGER.info("download image file: %s", photo)
+    def download_photo(self, message):
+        return self._run(self.async_client.download_photo(message))
@@ -0,0 +1,291 @@
+"""将 Telegram 原始消息序列化为 JSON Lines 格式的样本，并离线重放消息解析流程
+
+每行样本是一条原始消息，字段如下::
+
+    {
+        "id": 1,
+        "date": "2024-01-01T00:00:00+00:00",
+        "chat": {"title": "微信 group"},
+        "raw_text": "Alice:\\nhello",
+        "text": "Alice:\\nhello",
+        "entities": [{"_": "MessageEntityTextUrl", "offset": 0, "length": 5, "url": "..."}],
+        "media": "MessageMediaPhoto",
+        "photo": {"id": 1, "sizes": 3},
+        "from_id": 42,
+        "sender": "alice",
+        "reply_to_msg_id": null
+    }
+
+重放时这些字段会被还原为与 Telethon 消息具有相同属性的 ReplayMessage，
+``Message.parse`` 可以在不连接网络的情况下完整运行
+"""
+
+import datetime
+import json
+import random
+import time
+from collections import OrderedDict
+
+from telethon.tl import types as tl_types
+from telethon.tl.types import MessageEntityTextUrl, Photo, PhotoSize
+
+from .telegram import WX_ARTICLE_PREFIX, WX_LINK_PREFIX, Message, MessageType
+
+CHAT_NAME_FIELDS = ("title", "username", "first_name")
+
+
+def dump_message(message, sender=None):
+    """将 Telethon 消息转换为可以序列化为 JSON 的样本
+
+    Parameters
+    ----------
+    message: telethon.tl.custom.Message
+        原始消息
+    sender: str
+        发送者名称，重放时作为非微信消息的发送者
+    """
+    chat = {
+        field: getattr(message.chat, field)
+        for field in CHAT_NAME_FIELDS
+        if hasattr(message.chat, field)
+    }
+
+    photo = None
+    if isinstance(message.photo, Photo):
+        photo = {"id": message.photo.id, "sizes": len(message.photo.sizes or [])}
+
+    entities = None
+    if message.entities is not None:
+        entities = [entity.to_dict() for entity in message.entities]
+
+    from_id = None
+    if message.from_id is not None:
+        from_id = getattr(message.from_id, "user_id", None) or getattr(
+            message.from_id, "channel_id", None
+        )
+
+    return {
+        "id": message.id,
+        "date": message.date.isoformat() if message.date else None,
+        "chat": chat,
+        "raw_text": message.raw_text,
+        "text": message.text,
+        "entities": entities,
+        "media": type(message.media).__name__ if message.media else None,
+        "photo": photo,
+        "from_id": from_id,
+        "sender": sender,
+        "reply_to_msg_id": message.reply_to_msg_id,
+    }
+
+
+def load_entity(data):
+    data = dict(data)
+    entity_cls = getattr(tl_types, data.pop("_"))
+    return entity_cls(**data)
+
+
+class ReplayChat:
+    """只包含样本中记录的名称字段，与 Message.get_chat_name 的 hasattr 判断保持一致"""
+
+    def __init__(self, data):
+        for field, value in data.items():
+            setattr(self, field, value)
+
+
+class ReplayMessage:
+    """由样本还原的消息，提供 Message.parse 用到的 Telethon 消息属性"""
+
+    def __init__(self, data):
+        self.data = data
+        self.id = data["id"]
+        self.date = datetime.datetime.fromisoformat(data["date"]) if data.get("date") else None
+        self.chat = ReplayChat(data.get("chat") or {})
+        self.raw_text = data.get("raw_text")
+        self.text = data.get("text", self.raw_text)
+        self.media = data.get("media")
+        self.from_id = data.get("from_id")
+        self.reply_to_msg_id = data.get("reply_to_msg_id")
+        self.client = None
+
+        self.entities = None
+        if data.get("entities") is not None:
+            self.entities = [load_entity(entity) for entity in data["entities"]]
+
+        self.photo = None
+        if data.get("photo"):
+            sizes = [PhotoSize("x", 800, 600, 0) for _ in range(data["photo"]["sizes"])]
+            self.photo = Photo(data["photo"]["id"], 0, b"", self.date, sizes, 0)
+
+    @property
+    def sender(self):
+        """重放时使用的发送者，没有记录发送者时使用其 ID"""
+        if self.from_id is None:
+            return None
+
+        return self.data.get("sender") or str(self.from_id)
+
+    def parse(self, config=None):
+        return Message.parse(self, config=config, user=self.sender)
+
+
+def save_fixtures(records, path):
+    """将样本逐行写入 JSON Lines 文件，返回写入的样本数量"""
+    count = 0
+    with open(path, "w") as fout:
+        for record in records:
+            fout.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+
+    return count
+
+
+def load_fixtures(path):
+    """逐行读取样本文件，返回 ReplayMessage"""
+    with open(path) as fin:
+        for line in fin:
+            line = line.strip()
+            if line:
+                yield ReplayMessage(json.loads(line))
+
+
+def replay_messages(messages, config=None, ignore_rules=None):
+    """离线运行消息解析流程，返回解析得到的 Message
+
+    与在线获取消息时一样，命中 ignore_rules 的消息和解析后没有内容的消息不会返回
+    """
+    for message in messages:
+        if (
+            ignore_rules is not None
+            and isinstance(message.raw_text, str)
+            and ignore_rules.search(message.raw_text)
+        ):
+            continue
+
+        msg = message.parse(config=config)
+        if msg.content:
+            yield msg
+
+
+def generate_fixtures(size, seed=0):
+    """生成合成样本，覆盖 Message.parse 支持的所有消息类型
+
+    用于没有真实样本时的性能测试，各类型数量大致相同
+    """
+    rand = random.Random(seed)
+    words = ["hello", "微信", "文章", "今天", "meeting", "ok", "图片", "https://t.me/x", "🙂"]
+    names = ["Alice", "Bob", "张三", "李四[Group]", "💬👤 王五"]
+    start = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+    def sentence():
+        return " ".join(rand.choice(words) for _ in range(rand.randint(1, 30)))
+
+    def wx_text():
+        name = rand.choice(names)
+        lines = [sentence() for _ in range(rand.choice([1, 1, 2, 5, 20]))]
+        if rand.random() < 0.5:
+            return f"{name}:\n" + "\n".join(lines)
+        return "\n".join(f"{name}: {line}" for line in lines)
+
+    def wx_article():
+        name, title = rand.choice(names), sentence()
+        raw_text = f"{WX_ARTICLE_PREFIX} {name}:\n{WX_LINK_PREFIX} {title}\n{sentence()}"
+        url = (
+            "https://mp.weixin.qq.com/s?__biz=MzA&mid=2650&idx=1"
+            f"&sn={rand.getrandbits(64):x}&chksm=abc&scene=0"
+        )
+        entities = [
+            {"_": "MessageEntityBold", "offset": 0, "length": len(name) + 3},
+            MessageEntityTextUrl(len(name) + 4, len(title) + 2, url).to_dict(),
+        ]
+        return raw_text, entities
+
+    records = []
+    for idx in range(1, size + 1):
+        kind = rand.choice(["wx_text", "wx_image", "wx_article", "text", "image", "multi"])
+        record = {
+            "id": idx,
+            "date": (start + datetime.timedelta(seconds=idx)).isoformat(),
+            "chat": {"title": "group"},
+            "raw_text": "",
+            "entities": [],
+            "media": None,
+            "photo": None,
+            "from_id": idx % 7 + 1,
+            "sender": f"user{idx % 7 + 1}",
+            "reply_to_msg_id": None,
+        }
+        if kind.startswith("wx_"):
+            record.update(chat={"title": "微信 group"}, from_id=None, sender=None)
+
+        if kind == "wx_text":
+            record["raw_text"] = wx_text()
+        elif kind == "wx_article":
+            record["raw_text"], record["entities"] = wx_article()
+        elif kind == "text":
+            record["raw_text"] = sentence()
+        else:
+            record["media"] = "MessageMediaPhoto"
+            record["photo"] = {"id": idx, "sizes": 3}
+            if kind == "wx_image":
+                record["raw_text"] = f"{rand.choice(names)}:\nsent a picture."
+            elif kind == "multi":
+                record["raw_text"] = sentence()
+
+        record["text"] = record["raw_text"]
+        records.append(record)
+
+    return records
+
+
+def generate_message_corpus(size, seed=0):
+    """生成用于性能测试的合成消息，约 10% 的消息会命中默认的忽略规则"""
+    rand = random.Random(seed)
+    words = ["hello", "微信", "文章", "link", "今天", "meeting", "ok", "图片", "https://t.me/x"]
+    ignored = ["WeChat Slave", "tele_wechat_bot", "/start", "System", "Cancelled"]
+    corpus = []
+    for _ in range(size):
+        text = " ".join(rand.choice(words) for _ in range(rand.randint(3, 120)))
+        if rand.random() < 0.1:
+            keyword = rand.choice(ignored)
+            text = keyword + " " + text if keyword[0] in "/C" else text + " " + keyword
+        corpus.append(text)
+
+    return corpus
+
+
+def benchmark_parse(messages, repeat=3, config=None):
+    """按消息类型分别测试 Message.parse 的速度
+
+    Parameters
+    ----------
+    messages: list of ReplayMessage
+        用于测试的消息
+    repeat: int
+        每种类型重复测试的次数，取其中最快的一次
+
+    Return
+    ------
+    results: list of tuple
+        每种类型一个 (类型, 消息数量, 耗时秒数)，按类型定义顺序排列
+    """
+    groups = OrderedDict((msg_type, []) for msg_type in MessageType)
+    for message in messages:
+        groups[Message.get_message_type(message) or MessageType.OTHER].append(message)
+
+    results = []
+    for msg_type, group in groups.items():
+        if not group:
+            continue
+
+        elapsed = None
+        for _ in range(repeat):
+            begin = time.perf_counter()
+            for message in group:
+                message.parse(config=config)
+            cost = time.perf_counter() - begin
+            elapsed = cost if elapsed is None else min(elapsed, cost)
+
+        results.append((msg_type, len(group), elapsed))
+
+    return results
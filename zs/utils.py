@@ -0,0 +1,111 @@
+import json
+
+
+class JSONStreamBuffer:
+    """从文件中按块读取 JSON 文本，只保留尚未解析的部分，内存占用与文件大小无关"""
+
+    WHITESPACE = " \t\n\r"
+    NUMBER_CHARS = set("0123456789+-.eE")
+
+    def __init__(self, fp, chunk_size=65536):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.data = ""
+        self.pos = 0
+        self.eof = False
+
+    def read_more(self):
+        # 单个值超过一块时按已缓存的长度成倍读取，保证重试解析的总代价是线性的
+        chunk = self.fp.read(max(self.chunk_size, len(self.data) - self.pos))
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.data = self.data[self.pos :] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """跳过空白，返回下一个字符，文件结束时返回空字符串"""
+        while True:
+            while self.pos < len(self.data) and self.data[self.pos] in self.WHITESPACE:
+                self.pos += 1
+            if self.pos < len(self.data):
+                return self.data[self.pos]
+            if not self.read_more():
+                return ""
+
+    def expect(self, char):
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"expected {char!r} but got {found or 'EOF'!r}")
+        self.pos += 1
+
+    def decode(self):
+        """解析下一个完整的 JSON 值"""
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.data, self.pos)
+            except json.JSONDecodeError:
+                if self.read_more():
+                    continue
+                raise
+
+            # 数字没有结束符号，在缓冲区末尾时可能被截断（如 `-2.5` 只读到了 `-2.`），
+            # 需要读到更多内容后重新解析
+            if (
+                not self.eof
+                and isinstance(value, (int, float))
+                and all(char in self.NUMBER_CHARS for char in self.data[end:])
+                and self.read_more()
+            ):
+                continue
+
+            self.pos = end
+            return value
+
+
+def iter_json_object(fp, chunk_size=65536):
+    """逐个返回 JSON 文件顶层对象的成员，不需要将整个文件读入内存
+
+    Parameters
+    ----------
+    fp: file
+        以文本模式打开的文件
+    chunk_size: int
+        每次从文件读取的字符数
+
+    Return
+    ------
+    members: generator
+        依次返回 (key, value)
+    """
+    stream = JSONStreamBuffer(fp, chunk_size)
+    stream.expect("{")
+    if stream.peek() == "}":
+        return
+
+    while True:
+        key = stream.decode()
+        if not isinstance(key, str):
+            raise ValueError(f"expected an object key but got {key!r}")
+
+        stream.expect(":")
+        yield key, stream.decode()
+
+        found = stream.peek()
+        if found == "}":
+            return
+        if found != ",":
+            raise ValueError(f"expected ',' or '}}' but got {found or 'EOF'!r}")
+        stream.pos += 1
+
+
+def iter_json_lines(fp):
+    """逐行解析 JSON Lines 文件，跳过空行"""
+    for line in fp:
+        line = line.strip()
+        if line:
+            yield json.loads(line)